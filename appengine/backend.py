@@ -14,10 +14,12 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import hashlib
 import logging
+import re
+import time
 import urllib
 import urlparse
-import xml.etree.ElementTree as et
 
 from google.appengine.ext import db
 from google.appengine.ext.db import Query
@@ -30,8 +32,11 @@ from google.appengine.api import taskqueue
 
 import bindex
 import config
+import known_ids
 import model
-import story_parser
+import page_cache
+import queries
+import search
 
 _BINDEXED_FIELDS = [
     'story_year',
@@ -44,6 +49,9 @@ _BINDEXED_FIELDS = [
     'topics'
     ]
 
+# Max number of entities written by a single db.put
+_PUT_BATCH_SIZE = 100
+
 def _parse_bool(input):
     return input.lower() == 'true'
 
@@ -58,6 +66,15 @@ def _fetch_xml(offset, count, force=False):
                               offset=offset,
                               count=count))
 
+def _fetch_backfill_window(run, offset, count, stride, force=False):
+    taskqueue.add(url='/backend/fetch_xml',
+                  queue_name='backfill-queue',
+                  params=dict(force=force,
+                              offset=offset,
+                              count=count,
+                              run=run,
+                              stride=stride))
+
 def _parse_stories(ids):
     # Schedule a task to parse all these id's.  For now, just put all
     # of them (at most 20) into a single task.  This should help keep
@@ -75,14 +92,73 @@ def _parse_stories(ids):
                   params=dict(ids=id_param,
                               task=True))
 
+class _BackfillRun(db.Model):
+    """State shared by all the fetch windows of one backfill."""
+    date_added = db.DateTimeProperty(auto_now_add=True)
+    windows = db.IntegerProperty()
+
+    # The lowest offset the API has told us is past the end of the
+    # archive.
+    end_offset = db.IntegerProperty()
+
+def _backfill_mc_key(run):
+    return 'backfill_end:' + run
+
+def _get_backfill_end(run):
+    end_offset = memcache.get(_backfill_mc_key(run))
+    if end_offset is None:
+        state = _BackfillRun.get_by_key_name(run)
+        if state is not None and state.end_offset is not None:
+            end_offset = state.end_offset
+            memcache.set(_backfill_mc_key(run), end_offset)
+    return end_offset
+
+def _set_backfill_end(run, offset):
+    def txn():
+        state = _BackfillRun.get_by_key_name(run)
+        if state is None:
+            state = _BackfillRun(key_name=run)
+        if state.end_offset is None or offset < state.end_offset:
+            state.end_offset = offset
+            state.put()
+        return state.end_offset
+    end_offset = db.run_in_transaction(txn)
+    memcache.set(_backfill_mc_key(run), end_offset)
+
+def _start_backfill(count, force=False):
+    """Fans out one fetch chain per window.
+
+    Window N starts at page N and then strides over every
+    BACKFILL_WINDOWS'th page, so the windows cover the whole archive
+    between them.  How many of them actually run at once is capped by
+    the backfill-queue settings in queue.yaml."""
+    windows = config.BACKFILL_WINDOWS.get()
+    run = str(int(time.time() * 1000))
+    _BackfillRun(key_name=run, windows=windows).put()
+
+    logging.info('Starting backfill %s with %d windows' % (run, windows))
+    stride = windows * count
+    for window in range(windows):
+        # The NPR API always starts with 1
+        _fetch_backfill_window(run,
+                               offset=1 + (window * count),
+                               count=count,
+                               stride=stride,
+                               force=force)
+
 class FetchAll(webapp.RequestHandler):
     def get(self):
         force_refresh = _parse_bool(self.request.get('force', 'False'))
+        backfill = _parse_bool(self.request.get('backfill', 'False'))
 
-        # Schedule the first task.  The NPR API always starts with 1
-        _fetch_xml(offset=1,
-                   count=config.NUM_STORIES_TO_FETCH.get(),
-                   force=force_refresh)
+        if backfill:
+            _start_backfill(count=config.NUM_STORIES_TO_FETCH.get(),
+                            force=force_refresh)
+        else:
+            # Schedule the first task.  The NPR API always starts with 1
+            _fetch_xml(offset=1,
+                       count=config.NUM_STORIES_TO_FETCH.get(),
+                       force=force_refresh)
 
         # Return success
         self.response.headers['Content-Type'] = 'text/plain'
@@ -93,44 +169,141 @@ def _build_api_url(path, query_map):
     query = urllib.urlencode(query_map)
     return urlparse.urlunparse(['http', config.NPR_API_HOSTNAME.get(), path, '', query, ''])
 
-def _retrieve_url(url):
+def _open_url(url):
     try:
-        f = urllib.urlopen(url)
-        res = f.read()
-        f.close()
-        return res
+        return urllib.urlopen(url)
     except:
         return None
 
 class NoMoreStories(Exception):
     pass
 
+class FetchError(Exception):
+    """Raised when a page of stories couldn't be fetched or read."""
+    pass
+
+# Matches the start tag of a <story>, but not <storyDate> and friends.
+_STORY_START_RE = re.compile(r'<story[\s>]')
+_STORY_END = '</story>'
+_STORY_ID_RE = re.compile(r'\sid="([^"]*)"')
+
+# The API will return message 401 when we're done.
+_END_MESSAGE_RE = re.compile(r'<message[^>]*\sid="401"')
+
+_READ_SIZE = 16 * 1024
+
+def _iter_stories(fp):
+    """Yields (id, xml) for each <story> in an API response.
+
+    The response is scanned as it is read rather than parsed into a
+    tree, and each story comes back as the raw bytes from the response
+    so it can be stored without being re-serialized.  Every search
+    picks up where the last one left off, so each byte is only looked
+    at once however the response is split into reads.  Raises
+    NoMoreStories if the response says we're past the last story."""
+    buf = ''
+    eof = False
+    # The start tag of the story being read, and where to carry on
+    # searching buf from.
+    start = None
+    pos = 0
+    while True:
+        end = -1
+        if start is None:
+            start = _STORY_START_RE.search(buf, pos)
+            if start is None:
+                # A start tag could straddle the end of the read
+                pos = max(0, len(buf) - len('<story'))
+            else:
+                pos = start.end()
+        if start is not None:
+            end = buf.find(_STORY_END, pos)
+            if end == -1:
+                pos = max(pos, len(buf) - len(_STORY_END) + 1)
+
+        if end == -1:
+            if eof:
+                # Whatever is left can't hold a whole story
+                if _END_MESSAGE_RE.search(buf):
+                    raise NoMoreStories()
+                return
+            chunk = fp.read(_READ_SIZE)
+            if not chunk:
+                eof = True
+            buf += chunk
+            continue
+
+        # Messages only show up outside of stories
+        if _END_MESSAGE_RE.search(buf, 0, start.start()):
+            raise NoMoreStories()
+
+        end += len(_STORY_END)
+        xml = buf[start.start():end]
+        buf = buf[end:]
+        start = None
+        pos = 0
+
+        id = _STORY_ID_RE.search(xml, 0, xml.index('>'))
+        if id is None:
+            logging.error('Skipping story without an id')
+            continue
+        yield (id.group(1), xml)
+
 def _query_stories_for_show(show_id, api_key, start_num, num_results=20):
+    """Returns a list of (id, xml) for a page of stories.
+
+    Raises FetchError if the page couldn't be fetched or read, and
+    NoMoreStories if it's past the last story."""
     url = _build_api_url('query', dict(startNum=start_num,
                                       numResults=num_results,
                                       id=show_id,
                                       apiKey=api_key))
     logging.info('Getting API results from URL %s'  % url)
     
-    data = _retrieve_url(url)
-    if data == None:
-        logging.error('error trying to fetch: %s' % url)
-        return []
-    
+    f = _open_url(url)
+    if f == None:
+        raise FetchError('Error trying to fetch: %s' % url)
+
     try:
-        doc = et.fromstring(data)
-    except:
-        logging.error('Unable to parse data for request')
-        return []
+        try:
+            return list(_iter_stories(f))
+        except NoMoreStories:
+            raise
+        except:
+            raise FetchError('Unable to read data for request: %s' % url)
+    finally:
+        f.close()
 
-    # The API will return message 401 when we're done.
-    messages = doc.findall('message')
-    for message in messages:
-        if message.attrib['id'] == '401':
-            raise NoMoreStories()
-    
-    # Return all the stories as et nodes
-    return doc.findall('list/story')
+def _find_new_ids(ids):
+    """Returns the set of ids that haven't been stored yet."""
+    known = known_ids.find_known(ids)
+    unknown = [id for id in ids if id not in known]
+    if len(unknown) == 0:
+        return set()
+
+    # Anything missing from the known id index is checked against the
+    # datastore with a single batched lookup.  Stories stored before
+    # the index existed get added to it as they're found.
+    found = [id for (id, story)
+             in zip(unknown, model.FullStory.get_by_key_name(unknown))
+             if story is not None]
+    if len(found) != 0:
+        known_ids.add(found)
+
+    return set(unknown) - set(found)
+
+def _xml_digest(xml):
+    return hashlib.sha1(xml).hexdigest()
+
+def _find_changed_ids(digests):
+    """Returns the set of ids whose XML differs from what's stored.
+
+    digests is a dict of id -> digest of the freshly fetched XML.
+    Stories stored before digests were recorded always count as
+    changed."""
+    stored = known_ids.get_digests(digests.keys())
+    return set([id for (id, digest) in digests.items()
+                if stored.get(id) != digest])
 
 class FetchXml(webapp.RequestHandler):
     def get(self):
@@ -144,8 +317,20 @@ class FetchXml(webapp.RequestHandler):
         offset = _parse_int(self.request.get('offset'))
         count = _parse_int(self.request.get('count'))
 
+        # Only set for the windows of a backfill
+        run = self.request.get('run', None)
+
         logging.info('FetchXml: %d/%d' % (offset, count))
 
+        if run is not None:
+            end_offset = _get_backfill_end(run)
+            if end_offset is not None and offset >= end_offset:
+                logging.info('Backfill %s already ended at %d, stopping window'
+                             % (run, end_offset))
+                self.response.headers['Content-Type'] = 'text/plain'
+                self.response.out.write('OK')
+                return
+
         try:
             stories = _query_stories_for_show(config.FRESH_AIR_ID.get(),
                                               config.NPR_API_KEY.get(),
@@ -154,62 +339,79 @@ class FetchXml(webapp.RequestHandler):
         except NoMoreStories:
             logging.warning('API returned error indicating at end of stories.')
 
+            if run is not None:
+                # Stop every other window that is past this point
+                _set_backfill_end(run, offset)
+
             # Return success
             self.response.headers['Content-Type'] = 'text/plain'
             self.response.out.write('OK')
             return
+        except FetchError, e:
+            # Fail the task, so the queue tries the same page again
+            # rather than skipping it
+            logging.error(str(e))
+            self.response.set_status(500)
+            return
+
+        xml = dict(stories)
+        digests = dict([(id, _xml_digest(xml[id])) for id in xml])
+
+        ids = [id for (id, _) in stories]
+        if force_refresh:
+            # Force refresh, put anything that changed
+            new_ids = _find_changed_ids(digests)
+        else:
+            new_ids = _find_new_ids(ids)
 
         full_stories = []
-        done = False
-        story_stored = False
-        for story in stories:
-            # Create a FullStory object and commit it
-            id = story.attrib['id']
-
-            if not force_refresh:
-                # See if we already have this id
-                q = Query(model.FullStory, keys_only=True)
-                q.filter('id ==', id)
-                
-                if q.get() is None:
-                    # New id
-                    logging.info('Putting storyid %s into datastore' % id)
-                
-                    full_stories.append(model.FullStory(key_name=id,
-                                                        id=id,
-                                                        xml=et.tostring(story)))
+        for id in ids:
+            # Create a FullStory object for everything we need to store
+            if id not in new_ids:
+                continue
 
-                    # And signal that something was stored
-                    story_stored = True                                    
-            else:
-                # Force refresh, always put
-                logging.info('Putting storyid %s into datastore' % id)
-                
-                full_stories.append(model.FullStory(key_name=id,
-                                                    id=id,
-                                                    xml=et.tostring(story)))
-                # And signal that something was stored
-                story_stored = True                
+            logging.info('Putting storyid %s into datastore' % id)
+            full_story = model.FullStory(key_name=id,
+                                         id=id,
+                                         xml_digest=digests[id])
+            full_story.set_xml(xml[id])
+            full_stories.append(full_story)
 
+        # If we stored something, signal to keep going
+        story_stored = len(full_stories) != 0
 
         # store them all in bulk
-        if len(full_stories) != 0:
+        if story_stored:
             db.put(full_stories)
+            stored_ids = [full_story.id for full_story in full_stories]
+            known_ids.add(dict([(id, digests[id]) for id in stored_ids]))
 
             if config.AUTO_PARSE_XML.get():
-                _parse_stories([story.attrib['id'] for story in stories])        
-
-        if story_stored:
-            # this means we stored something, so keep going
+                _parse_stories(stored_ids)
+
+        if run is not None and len(stories) == 0:
+            # An error the API doesn't mark as the end (like a bad API
+            # key) would otherwise keep the window going forever
+            logging.warning('Backfill %s got no stories at %d, stopping '
+                            'window' % (run, offset))
+        elif run is not None:
+            # Backfill windows don't stop on pages they've already
+            # seen, they keep going until they run off the end.
+            stride = _parse_int(self.request.get('stride'))
+            _fetch_backfill_window(run,
+                                   offset=offset + stride,
+                                   count=count,
+                                   stride=stride,
+                                   force=force_refresh)
+        elif story_stored or (force_refresh and len(stories) != 0):
+            # this means we stored something (or we're refreshing
+            # everything), so keep going
             new_offset = offset + count
             logging.info('Keep going! %s/%d' % (new_offset, count))
 
             _fetch_xml(offset=new_offset,
                        count=config.NUM_STORIES_TO_FETCH.get(),
                        force=force_refresh)
-        else:
-            # We're at the end, let's flush the cache
-            memcache.flush_all()
 
         # Return success
         self.response.headers['Content-Type'] = 'text/plain'
@@ -236,31 +438,91 @@ class ParseXml(webapp.RequestHandler):
             self.response.out.write('OK')            
             return
 
+        # Only parse tasks need the XML parser, so don't make every
+        # instance load it.
+        import story_parser
+
         # Bulk get all stories
         stories = model.FullStory.get_by_key_name(ids)
 
+        # Parse everything in memory first...
+        to_parse = []
         for (id, full_story) in zip(ids, stories):
             if full_story is None:
                 logging.info('Story %s could not be found' % id)
                 continue
                 
             logging.info('Going to parse id %s' % id)
-
-            (parsed_story, preview) = story_parser.parse_full_story(full_story.xml,
-                                                                    full_story)
-
-            # Need to store these together in the same transaction
-            db.run_in_transaction(lambda x,y: db.put([x, y]),
-                                  parsed_story, preview)
-
-            # Also bindex some useful fields
-            bindex.index(parsed_story, _BINDEXED_FIELDS)
-            bindex.index(preview, _BINDEXED_FIELDS)            
+            to_parse.append((full_story.get_xml(), full_story))
+
+        parsed = []
+        previews = []
+        parsed_stories = []
+        for (preview, parsed_story) in story_parser.parse_full_stories(to_parse):
+            previews.append(preview)
+            parsed_stories.append(parsed_story)
+            parsed.append(preview)
+            parsed.append(parsed_story)
+
+        # Get what was indexed last time the stories were parsed, so
+        # the indexes only have to change where the stories did.
+        old_previews = []
+        old_stories = []
+        if len(previews) != 0:
+            old_parsed = db.get([story.key() for story in parsed])
+            old_previews = old_parsed[0::2]
+            old_stories = old_parsed[1::2]
+
+        # Bindex some useful fields, with one update for the whole
+        # task.  Only previews are indexed; the Story for a preview is
+        # its child with the same key name.  Values a story no longer
+        # has are dropped from the index.
+        #
+        # This has to happen before the stories are put: a retry diffs
+        # against whatever is stored, so if the puts went first and the
+        # task died before indexing, the retry would see nothing to
+        # change.  Applying the same changes twice does nothing.
+        bindex.update(zip(old_previews, previews), _BINDEXED_FIELDS,
+                      order_by='publish_date')
+        search.update(zip(old_stories, parsed_stories))
+
+        # ...then write it all out in bulk.  These used to be put a
+        # story at a time in a transaction, but the puts are idempotent
+        # so a task retry cleans up after a partial write.
+        for start in range(0, len(parsed), _PUT_BATCH_SIZE):
+            db.put(parsed[start:start + _PUT_BATCH_SIZE])
+
+        # Only drop the cached results these stories could show up in
+        if len(previews) != 0:
+            queries.stories_changed([preview.id for preview in previews])
+            page_cache.content_changed()
         
         # Return success
         self.response.headers['Content-Type'] = 'text/plain'
         self.response.out.write('OK')
 
+def _find_stale_ids(ids):
+    """Returns the ids whose parse is missing or from an older parser."""
+    import story_parser
+    keys = []
+    for id in ids:
+        full_story_key = Key.from_path(model.FullStory.kind(), id)
+        preview_key = Key.from_path(model.StoryPreview.kind(), id,
+                                    parent=full_story_key)
+        keys.append(preview_key)
+        keys.append(Key.from_path(model.Story.kind(), id,
+                                  parent=preview_key))
+    parsed = db.get(keys)
+
+    stale = []
+    for (i, id) in enumerate(ids):
+        for story in parsed[2 * i:2 * i + 2]:
+            if (story is None or story.xml_parser_version is None or
+                story.xml_parser_version < story_parser._XML_PARSER_VERSION):
+                stale.append(id)
+                break
+    return stale
+
 class ReparseXml(webapp.RequestHandler):
     def get(self):
         self._handle()
@@ -270,6 +532,10 @@ class ReparseXml(webapp.RequestHandler):
     def _handle(self):
         in_task = _parse_bool(self.request.get('task', 'False'))
         cursor = self.request.get('cursor', None)
+        # Only reparse stories the current parser hasn't seen
+        stale_only = _parse_bool(self.request.get('stale', 'False'))
+        scanned = _parse_int(self.request.get('scanned', '0'))
+        queued = _parse_int(self.request.get('queued', '0'))
 
         if not in_task:
             logging.info('Request to reparse found, posting a task.')
@@ -277,7 +543,8 @@ class ReparseXml(webapp.RequestHandler):
             # Post a new task to ourselves
             taskqueue.add(url='/backend/reparse_xml',
                           queue_name='parse-queue',
-                          params=dict(task=True))
+                          params=dict(task=True,
+                                      stale=stale_only))
 
             # Return success
             self.response.headers['Content-Type'] = 'text/plain'
@@ -303,33 +570,154 @@ class ReparseXml(webapp.RequestHandler):
         ids = list(set([story.name() for story in stories]))
 
         if len(ids) == 0:
+            logging.info('Reparse done: %d stories scanned, %d queued '
+                         'for parsing' % (scanned, queued))
             # Bail
             self.response.headers['Content-Type'] = 'text/plain'
             self.response.out.write('OK')
-
-            # and flush the cache
-            memcache.flush_all()            
             return
 
-        logging.info('Handling stories %s' % ids)            
+        scanned += len(ids)
+        if stale_only:
+            ids = _find_stale_ids(ids)
+        queued += len(ids)
+        logging.info('Reparse progress: %d stories scanned, %d queued '
+                     'for parsing' % (scanned, queued))
+
+        if len(ids) != 0:
+            logging.info('Handling stories %s' % ids)            
 
-        # And have them all parsed (in another task as well)
-        _parse_stories(ids)
+            # And have them all parsed (in another task as well)
+            _parse_stories(ids)
 
         # New task to parse the rest
         taskqueue.add(url='/backend/reparse_xml',
                       queue_name='parse-queue',
                       params=dict(task=True,
-                                  cursor=cursor))        
+                                  cursor=cursor,
+                                  stale=stale_only,
+                                  scanned=scanned,
+                                  queued=queued))
         
         # Return success
         self.response.headers['Content-Type'] = 'text/plain'
         self.response.out.write('OK')    
             
 
+class CompressXml(webapp.RequestHandler):
+    """Migrates FullStory entities stored as text to compressed XML."""
+    def get(self):
+        self._handle()
+    def post(self):
+        self._handle()
+
+    def _handle(self):
+        in_task = _parse_bool(self.request.get('task', 'False'))
+        cursor = self.request.get('cursor', None)
+
+        if not in_task:
+            logging.info('Request to compress found, posting a task.')
+
+            # Post a new task to ourselves
+            taskqueue.add(url='/backend/compress_xml',
+                          queue_name='parse-queue',
+                          params=dict(task=True))
+
+            # Return success
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('OK')
+            return
+
+        logging.info('Compressing in task, cursor is %s' % cursor)
+
+        q = Query(model.FullStory)
+        if cursor is not None:
+            q.with_cursor(cursor)
+
+        stories = q.fetch(config.REPARSE_TASK_SIZE.get())
+        cursor = q.cursor()
+
+        if len(stories) == 0:
+            # Bail, we're done
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('OK')
+            return
+
+        # Stories without any XML have nothing to compress
+        to_compress = [story for story in stories
+                       if story.xml_format != model.XML_FORMAT_ZLIB and
+                       story.xml is not None]
+        for story in to_compress:
+            story.set_xml(story.get_xml())
+
+        if len(to_compress) != 0:
+            logging.info('Compressing stories %s' %
+                         [story.id for story in to_compress])
+            db.put(to_compress)
+
+        # New task to handle the rest
+        taskqueue.add(url='/backend/compress_xml',
+                      queue_name='parse-queue',
+                      params=dict(task=True,
+                                  cursor=cursor))
+
+        # Return success
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('OK')
+
+class ReorderBindex(webapp.RequestHandler):
+    """Moves every bindex value over to postings ordered by publish date.
+
+    ParseXml converts the values it writes to, this converts the ones
+    whose stories haven't been parsed again since.  Runs on parse-queue
+    so it never writes the bindex at the same time as ParseXml."""
+    def get(self):
+        self._handle()
+    def post(self):
+        self._handle()
+
+    def _handle(self):
+        in_task = _parse_bool(self.request.get('task', 'False'))
+        cursor = self.request.get('cursor', None)
+
+        if not in_task:
+            logging.info('Request to reorder found, posting a task.')
+
+            # Post a new task to ourselves
+            taskqueue.add(url='/backend/reorder_bindex',
+                          queue_name='parse-queue',
+                          params=dict(task=True))
+
+            # Return success
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('OK')
+            return
+
+        logging.info('Reordering bindex in task, cursor is %s' % cursor)
+
+        (converted, cursor) = bindex.reorder_heads('publish_date',
+                                                   model.StoryPreview,
+                                                   cursor)
+        if converted != 0:
+            logging.info('Reordered %d bindex values' % converted)
+            page_cache.content_changed()
+
+        if cursor is not None:
+            # New task to handle the rest
+            taskqueue.add(url='/backend/reorder_bindex',
+                          queue_name='parse-queue',
+                          params=dict(task=True,
+                                      cursor=cursor))
+
+        # Return success
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('OK')
+
 application = webapp.WSGIApplication([('/backend/fetch_all', FetchAll),
                                       ('/backend/fetch_xml', FetchXml),
                                       ('/backend/reparse_xml', ReparseXml),                                      
+                                      ('/backend/compress_xml', CompressXml),
+                                      ('/backend/reorder_bindex', ReorderBindex),
                                       ('/backend/parse_xml', ParseXml)],
                                      debug=True)
 
@@ -14,28 +14,168 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+"""A simple inverted index ("bindex") over datastore properties.
+
+Each indexed (property, value) pair gets a _BIndex head entity holding
+the value, the total number of refs and the layout of its posting
+list.  The posting list itself (the keys of every object with that
+value) is kept sorted and split across _BIndexShard entities of at most
+_SHARD_SIZE refs, so a value's write cost doesn't grow with the number
+of objects that have it.
+
+A posting is the encoded key of an object, optionally prefixed with a
+token built from one of the object's properties (see index()'s
+order_by).  Posting lists are sorted, so giving every object the same
+order_by lets query() combine lists with simple merges and hand back
+results in that order.
+
+The values of every property and their counts are also kept together in
+a single _BIndexSummary, so facets() can list them without scanning
+the heads."""
+
+import base64
+import bisect
+import cPickle as pickle
+import datetime
+import hashlib
+import logging
+import re
+import urllib
+
 from google.appengine.api import memcache
 from google.appengine.ext import db
 
+import cache
+
+# Max number of refs kept in a single shard.
+_SHARD_SIZE = 1000
+
+# Number of heads reorder_heads() looks at per call.
+_REORDER_BATCH = 20
+
+# Number of objects read at a time when reposting a head.
+_REPOST_BATCH = 500
+
+# Number of shards fetched at a time when reading a posting list.
+_SHARD_READ_BATCH = 10
+
+_SHARD_MEMCACHE_PREFIX = 'bindex_shard:'
+
+# Max number of values a prefix (^=) term can match (see query()).
+_MAX_PREFIX_VALUES = 100
+
 class _BIndex(db.Expando):
-    refs = db.ListProperty(db.Key)
     count = db.IntegerProperty()
 
+    # The property the postings are ordered by, if any.
+    order_by = db.StringProperty(indexed=False)
+
+    # The first ref of each shard (in order), and the id of that shard.
+    # The first shard always starts at ''.
+    shard_starts = db.StringListProperty(indexed=False)
+    shard_ids = db.ListProperty(int, indexed=False)
+
+class _BIndexShard(db.Model):
+    # Sorted, newline separated encoded refs.  Kept as text so it isn't
+    # indexed and has no list length limit.
+    refs = db.TextProperty()
+
+class _BIndexSummary(db.Model):
+    # Pickled dict of property -> dict of value -> count, for every
+    # value in the index.
+    values = db.BlobProperty()
+
+_SUMMARY_KEY_NAME = 'summary'
+_SUMMARY_CACHE_KEY = 'bindex_summary'
+
+def _shard_key_name(key_name, shard_id):
+    return '%s#%d' % (key_name, shard_id)
+
+def _encode_key(key):
+    """Encodes a key as its path, which is far smaller than a db.Key."""
+    path = key.to_path()
+    parts = []
+    for i in range(0, len(path), 2):
+        parts.append(path[i])
+        id_or_name = path[i + 1]
+        if isinstance(id_or_name, (int, long)):
+            parts.append('#%d' % id_or_name)
+        else:
+            if isinstance(id_or_name, unicode):
+                id_or_name = id_or_name.encode('utf-8')
+            parts.append(urllib.quote(id_or_name, safe=''))
+    return '/'.join(parts)
+
+def _decode_key(encoded):
+    path = encoded.split('/')
+    for i in range(1, len(path), 2):
+        if path[i].startswith('#'):
+            path[i] = int(path[i][1:])
+        else:
+            path[i] = urllib.unquote(path[i]).decode('utf-8')
+    return db.Key.from_path(*path)
+
+def _order_token(value):
+    """Turns a property value into a string that sorts the same way."""
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            # Parsed objects carry a timezone, ones read back from the
+            # datastore are naive UTC.  Make them agree.
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return value.strftime('%Y%m%d%H%M%S')
+    if isinstance(value, (int, long)):
+        return '%020d' % value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _make_posting(obj, order_by):
+    ref = _encode_key(obj.key())
+    if order_by is None:
+        return ref
+    return '%s\t%s' % (_order_token(obj.__getattribute__(order_by)), ref)
+
+def _posting_key(posting):
+    return _decode_key(posting.split('\t')[-1])
+
+def _decode_refs(text):
+    if not text:
+        return []
+    return text.split('\n')
+
+def _encode_refs(refs):
+    return db.Text('\n'.join(refs))
+
+def _get_shards(key_names):
+    """Returns a dict of shard key name -> list of encoded refs."""
+    found = memcache.get_multi(key_names, key_prefix=_SHARD_MEMCACHE_PREFIX)
+
+    missing = [k for k in key_names if k not in found]
+    if len(missing) != 0:
+        loaded = {}
+        for (k, shard) in zip(missing, _BIndexShard.get_by_key_name(missing)):
+            if shard is None:
+                loaded[k] = []
+            else:
+                loaded[k] = _decode_refs(shard.refs)
+        memcache.set_multi(loaded, key_prefix=_SHARD_MEMCACHE_PREFIX)
+        found.update(loaded)
+    return found
+
 def _is_not_property_empty(obj, prop):
     obj_properties = obj.properties()
     return prop in obj_properties and not obj_properties[prop].empty(obj.__getattribute__(prop))
 
 def _calc_key_name(key, value):
-    return '='.join(map(str, [key, value]))    
+    return u'='.join(map(unicode, [key, value]))
 
-def index(obj, properties):
-    key = obj.key()
-
-    entries = []
+def _indexed_values(obj, properties):
+    """Yields (prop, value) for every value of obj that gets indexed."""
+    obj_properties = obj.properties()
     for prop in properties:
         if _is_not_property_empty(obj, prop):
-            obj_properties = obj.properties()
-
             attrs = [obj.__getattribute__(prop)]
 
             # Special case for handling string lists.
@@ -43,32 +183,364 @@ def index(obj, properties):
                 attrs = obj.__getattribute__(prop)
 
             for attr in attrs:
-                key_name = _calc_key_name(prop, attr)
-                # Look up the _BIndex entry using prop as the key
-                entry = _BIndex.get_by_key_name(key_name)
-                if entry == None:
-                    # Create a new entry
-                    entry =_BIndex(key_name=key_name)
-                
-                    # Add  an expando key for this property
-                    entry.__setattr__(prop, attr)
+                yield (prop, attr)
+
+def _new_head(key_name, prop, attr, order_by):
+    head = _BIndex(key_name=key_name, count=0, order_by=order_by,
+                   shard_starts=[''], shard_ids=[0])
+
+    # Add  an expando key for this property
+    head.__setattr__(prop, attr)
+    return head
+
+def _take_legacy_refs(head):
+    """Moves a head written before sharding over to the sharded layout.
+
+    Returns its old refs, encoded, so they can be inserted again."""
+    if 'refs' not in head.dynamic_properties():
+        return []
+    refs = [_encode_key(ref) for ref in head.refs]
+    del head.refs
+    head.count = 0
+    head.shard_starts = ['']
+    head.shard_ids = [0]
+    return refs
+
+def _insert_refs(head, shards, refs):
+    """Adds encoded refs to the posting list of head.
+
+    shards is a dict of shard key name -> list of refs that already
+    holds every shard the refs land in.  Shards that fill up are split,
+    and new ones get added to shards.  Returns the names of the shards
+    that changed."""
+    key_name = head.key().name()
+    changed = set()
+    for ref in sorted(refs):
+        pos = bisect.bisect_right(head.shard_starts, ref) - 1
+        shard_name = _shard_key_name(key_name, head.shard_ids[pos])
+        shard = shards[shard_name]
+
+        i = bisect.bisect_left(shard, ref)
+        if i < len(shard) and shard[i] == ref:
+            # Already linked
+            continue
+        shard.insert(i, ref)
+        head.count += 1
+        changed.add(shard_name)
+
+        if len(shard) > _SHARD_SIZE:
+            if pos == len(head.shard_ids) - 1:
+                # Refs mostly arrive in order, so when the tail fills
+                # up leave it full and start a new one.
+                split = _SHARD_SIZE
+            else:
+                split = len(shard) / 2
+
+            new_id = max(head.shard_ids) + 1
+            new_name = _shard_key_name(key_name, new_id)
+            shards[new_name] = shard[split:]
+            del shard[split:]
+            head.shard_starts.insert(pos + 1, shards[new_name][0])
+            head.shard_ids.insert(pos + 1, new_id)
+            changed.add(new_name)
+    return changed
+
+def _reset_head(head, order_by):
+    """Empties a head so it can be rebuilt with a new order_by.
+
+    Returns the names of the shards it no longer uses."""
+    logging.info('Reordering bindex %s by %s (%d refs)' %
+                 (head.key().name(), order_by, head.count or 0))
+    key_name = head.key().name()
+    old_shards = [_shard_key_name(key_name, shard_id)
+                  for shard_id in head.shard_ids]
+    head.count = 0
+    head.order_by = order_by
+    head.shard_starts = ['']
+    head.shard_ids = [max(head.shard_ids or [0]) + 1]
+    return old_shards
+
+def _repost(keys, order_by, cls, skip):
+    """Returns postings ordered by order_by for the objects with keys.
+
+    The objects are read back from the datastore.  Keys in skip
+    (encoded), objects that are gone and objects that aren't a cls are
+    left out; the last is how refs to other kinds of objects that old
+    layouts mixed in get dropped."""
+    keys = [key for key in keys if _encode_key(key) not in skip]
+    postings = []
+    for start in range(0, len(keys), _REPOST_BATCH):
+        for obj in db.get(keys[start:start + _REPOST_BATCH]):
+            if obj is not None and (cls is None or isinstance(obj, cls)):
+                postings.append(_make_posting(obj, order_by))
+    return postings
+
+def _remove_refs(head, shards, refs):
+    """Removes encoded refs from the posting list of head.
+
+    shards is a dict of shard key name -> list of refs that already
+    holds every shard the refs would be in.  Shards left empty are
+    dropped from the head's layout (unless it's the only one).  Returns
+    (names of shards that changed, names of shards that were dropped)."""
+    key_name = head.key().name()
+    changed = set()
+    for ref in refs:
+        pos = bisect.bisect_right(head.shard_starts, ref) - 1
+        shard_name = _shard_key_name(key_name, head.shard_ids[pos])
+        shard = shards[shard_name]
+
+        i = bisect.bisect_left(shard, ref)
+        if i < len(shard) and shard[i] == ref:
+            del shard[i]
+            head.count -= 1
+            changed.add(shard_name)
+
+    dropped = set()
+    for pos in reversed(range(len(head.shard_ids))):
+        shard_name = _shard_key_name(key_name, head.shard_ids[pos])
+        if (shard_name in changed and len(shards[shard_name]) == 0
+            and len(head.shard_ids) > 1):
+            del head.shard_ids[pos]
+            del head.shard_starts[pos]
+            dropped.add(shard_name)
+    # The first shard always starts at the very beginning
+    head.shard_starts[0] = ''
+    return (changed - dropped, dropped)
+
+def _entries(obj, properties, order_by):
+    """Returns a dict of key_name -> (prop, value, posting) for obj."""
+    res = {}
+    if obj is None:
+        return res
+    posting = _make_posting(obj, order_by)
+    for (prop, attr) in _indexed_values(obj, properties):
+        res[_calc_key_name(prop, attr)] = (prop, attr, posting)
+    return res
+
+def _bump_generations(values):
+    # Everything cached from a value any of the objects had or have is
+    # out of date, even if the posting itself didn't change.
+    generations = set()
+    for (key_name, (prop, attr)) in values.items():
+        generations.add(_value_generation(key_name))
+        generations.add(_field_generation(prop))
+    cache.bump_generations(list(generations))
+
+def update(changes, properties, order_by=None):
+    """Brings the index up to date with a batch of changed objects.
+
+    changes is a list of (old, new) pairs: the object as it was last
+    indexed and as it is now.  old is None for an object that's never
+    been indexed, and new is None for one that's gone.  Only the
+    postings that differ between the two are added or removed, and
+    values left with no objects at all are removed from the index.
+
+    If order_by names a property, postings are sorted by its value, so
+    queries return matches in that order.  Every object in an index
+    should use the same order_by.  A value whose postings were made
+    some other way (unordered, or before posting lists were sharded)
+    is converted the first time the batch touches it: every object it
+    refers to is read back and posted again, and refs to objects of a
+    different class than the batch's are dropped.
+
+    Heads and shards are read, changed and written back outside of
+    any transaction, so updates must not run concurrently with each
+    other (the app only updates from parse-queue tasks, which run one
+    at a time).
+
+    Every head the batch touches is fetched with one multi-get, and
+    only the shards the changed postings land in (normally just the
+    tail) are read and written back.  Afterwards the cache generation
+    of every value the objects had or have is bumped (see
+    generation_name())."""
+    _update(changes, properties, order_by)
+
+def _head_value(head):
+    """Returns the (prop, value) a head is for."""
+    for prop in head.dynamic_properties():
+        if prop != 'refs':
+            return (prop, head.__getattribute__(prop))
+    return (None, None)
+
+def _update(changes, properties, order_by, cls=None, reorder=[]):
+    """Does the work of update().
+
+    The heads named in reorder are also converted to order_by, if they
+    aren't already, whether or not the changes touch them.  cls is the
+    class of the indexed objects, if changes doesn't hold any."""
+    # key_name -> (prop, value)
+    values = {}
+    # key_name -> (prop, value, postings to link)
+    adds = {}
+    # key_name -> postings to unlink
+    removes = {}
+    # key_name -> every posting the new objects have, changed or not
+    current = {}
+    # Encoded keys of every object in the batch
+    batch_refs = set()
+    for (old, new) in changes:
+        for obj in [old, new]:
+            if obj is not None:
+                batch_refs.add(_encode_key(obj.key()))
+                cls = cls or obj.__class__
+        old_entries = _entries(old, properties, order_by)
+        new_entries = _entries(new, properties, order_by)
+        for (key_name, (prop, attr, posting)) in new_entries.items():
+            values[key_name] = (prop, attr)
+            current.setdefault(key_name, []).append(posting)
+            if old_entries.get(key_name, (None, None, None))[2] != posting:
+                (_, _, refs) = adds.setdefault(key_name, (prop, attr, []))
+                refs.append(posting)
+        for (key_name, (prop, attr, posting)) in old_entries.items():
+            values.setdefault(key_name, (prop, attr))
+            if new_entries.get(key_name, (None, None, None))[2] != posting:
+                removes.setdefault(key_name, []).append(posting)
+
+    key_names = list(set(adds.keys()) | set(removes.keys()) | set(reorder))
+    if len(key_names) == 0:
+        _bump_generations(values)
+        return
+
+    found = _BIndex.get_by_key_name(key_names)
+    heads = {}
+    stale_shards = []
+    for (key_name, head) in zip(key_names, found):
+        if head == None:
+            if key_name in adds:
+                (prop, attr, _) = adds[key_name]
+                heads[key_name] = _new_head(key_name, prop, attr, order_by)
+            # else there's nothing to remove from
+            continue
+
+        heads[key_name] = head
+        legacy = _take_legacy_refs(head)
+        if head.order_by != order_by:
+            if len(legacy) != 0:
+                keys = [_decode_key(ref) for ref in legacy]
+            else:
+                keys = [_posting_key(posting)
+                        for posting in _iter_postings(head)]
+            stale_shards.extend(_reset_head(head, order_by))
+            # Everything is posted again from scratch: the other objects
+            # from the datastore, the batch's own from the changes.
+            if key_name not in values:
+                values[key_name] = _head_value(head)
+            (prop, attr) = values[key_name]
+            removes.pop(key_name, None)
+            adds[key_name] = (prop, attr,
+                              _repost(keys, order_by, cls, batch_refs) +
+                              current.get(key_name, []))
+        elif order_by is None and len(legacy) != 0:
+            (prop, attr, refs) = adds.setdefault(key_name,
+                                                 (None, None, []))
+            refs.extend(legacy)
+
+    # Work out which shard every changed posting lands in, and get
+    # them all in one go.
+    wanted = set()
+    for (key_name, head) in heads.items():
+        refs = removes.get(key_name, []) + adds.get(key_name, (0, 0, []))[2]
+        for ref in refs:
+            pos = bisect.bisect_right(head.shard_starts, ref) - 1
+            wanted.add(_shard_key_name(key_name, head.shard_ids[pos]))
+    shards = _get_shards(list(wanted))
+
+    changed = set()
+    dropped = set()
+    for (key_name, head) in heads.items():
+        (head_changed, head_dropped) = _remove_refs(
+            head, shards, removes.get(key_name, []))
+        changed.update(head_changed)
+        dropped.update(head_dropped)
+        changed.update(_insert_refs(head, shards,
+                                    adds.get(key_name, (0, 0, []))[2]))
+
+    # Values nothing has any more go away completely
+    to_put = []
+    to_delete = [db.Key.from_path(_BIndexShard.kind(), name)
+                 for name in stale_shards + list(dropped)]
+    for (key_name, head) in heads.items():
+        if head.count > 0:
+            to_put.append(head)
+            continue
+        if head.is_saved():
+            to_delete.append(head.key())
+        for shard_id in head.shard_ids:
+            name = _shard_key_name(key_name, shard_id)
+            to_delete.append(db.Key.from_path(_BIndexShard.kind(), name))
+            changed.discard(name)
+            dropped.add(name)
+
+    # Bulk store the heads and the shards that changed
+    to_put.extend([_BIndexShard(key_name=name,
+                                refs=_encode_refs(shards[name]))
+                   for name in changed])
+    if len(to_put) != 0:
+        db.put(to_put)
+    if len(to_delete) != 0:
+        db.delete(to_delete)
+    memcache.delete_multi(list(changed | dropped),
+                          key_prefix=_SHARD_MEMCACHE_PREFIX)
+
+    _bump_generations(values)
+
+    # Values whose heads were already gone (say, on a retry) still get
+    # a count of 0, in case the summary missed them going.
+    counts = {}
+    for key_name in key_names:
+        head = heads.get(key_name)
+        if head is not None:
+            counts[values.get(key_name) or _head_value(head)] = max(
+                head.count, 0)
+        elif key_name in values:
+            counts[values[key_name]] = 0
+    _update_summary(counts)
 
-                # Link to this document (if not already linked).
-                if key not in entry.refs:
-                    entry.refs.append(key)
+def reorder_heads(order_by, cls, cursor=None):
+    """Converts a batch of heads to postings ordered by order_by.
 
-                # Update the count
-                entry.count = len(entry.refs)
+    update() converts the heads it writes to, this gets the rest: the
+    values none of whose objects have changed since.  cls is the class
+    of the indexed objects (see update()).  Returns (number of heads
+    converted, cursor to carry on from); the cursor is None once every
+    head has been looked at.
 
-                # Put this in the list of things we'll store at the end.
-                entries.append(entry)
+    The cursor is the key name of the last head looked at, rather than a
+    query cursor, since converting a head can delete it."""
+    q = _BIndex.all().order('__key__')
+    if cursor is not None:
+        q.filter('__key__ >', db.Key.from_path(_BIndex.kind(), cursor))
+    heads = q.fetch(_REORDER_BATCH)
+    stale = [head.key().name() for head in heads
+             if head.order_by != order_by]
+    if len(stale) != 0:
+        _update([], [], order_by, cls, stale)
 
-    # Bulk store the new _BIndex values
-    db.put(entries)
+    if len(heads) < _REORDER_BATCH:
+        return (len(stale), None)
+    return (len(stale), heads[-1].key().name())
 
+def index(objs, properties, order_by=None):
+    """Indexes properties of an object, or of a list of objects.
 
-# TODO(napier): would be nice to have a DSL here to specify more
-# complex queries.  Like 'foo = bar AND baz = quux'.
+    This only ever adds postings; use update() when objects that were
+    indexed before have changed.  See update() for order_by."""
+    if not isinstance(objs, (list, tuple)):
+        objs = [objs]
+    update([(None, obj) for obj in objs], properties, order_by)
+
+def _iter_postings(head):
+    """Yields the postings of a head in order, streaming its shards."""
+    key_name = head.key().name()
+    names = [_shard_key_name(key_name, shard_id)
+             for shard_id in head.shard_ids]
+    # Stream the shards in, a batch at a time
+    for start in range(0, len(names), _SHARD_READ_BATCH):
+        batch = names[start:start + _SHARD_READ_BATCH]
+        shards = _get_shards(batch)
+        for name in batch:
+            for posting in shards[name]:
+                yield posting
 
 class _BIndexQuery(object):
     def __init__(self, iterator):
@@ -79,53 +551,470 @@ class _BIndexQuery(object):
 
     def run(self):
         for i in self.items:
-            for r in i.refs:
-                yield r
+            if 'refs' in i.dynamic_properties():
+                # Not moved over to shards yet
+                for r in i.refs:
+                    yield r
+                continue
+
+            for posting in _iter_postings(i):
+                yield _posting_key(posting)
+
+def _value_generation(key_name):
+    return u'bindex:' + key_name
+
+def _field_generation(field):
+    return u'bindex_field:' + field
+
+def generation_name(field, value):
+    """Returns the cache generation bumped when objects with value change.
 
-def query(field, value, operator='='):
-    mc_key = ':'.join(map(str, ['bindex_query', field, value, operator]))
-    results = memcache.get(mc_key)
+    Anything cached from the objects indexed with field = value can be
+    tagged with it (see cache.generation_key())."""
+    return _value_generation(_calc_key_name(field, value))
+
+def _term_generation(field, value, operator):
+    if '=' == operator:
+        return generation_name(field, value)
+    # Comparisons can match any value of the field
+    return _field_generation(field)
+
+def _find_heads(field, value, operator):
+    mc_key = u':'.join(map(unicode, ['bindex_query', field, value, operator]))
+    mc_key = cache.generation_key(mc_key.encode('utf-8'),
+                                  [_term_generation(field, value, operator)])
+    results = cache.get(mc_key)
     if results != None:
-        return _BIndexQuery(results)
+        return results
         
     # Shortcut for '=' operator
     if '=' == operator:
         # Shortcut
         item = _BIndex.get_by_key_name(_calc_key_name(field, value))
         if item == None:
-            return _BIndexQuery([])
+            return []
         else:
-            memcache.set(mc_key, [item])
-            return _BIndexQuery([item])
+            cache.set(mc_key, [item])
+            return [item]
 
+    if '^=' == operator:
+        # Every value starting with value, which is a range of head
+        # key names
+        start = _calc_key_name(field, value)
+        q = _BIndex.all()
+        q.filter('__key__ >=', db.Key.from_path(_BIndex.kind(), start))
+        q.filter('__key__ <', db.Key.from_path(_BIndex.kind(),
+                                               start + u'\ufffd'))
+        results = q.fetch(_MAX_PREFIX_VALUES + 1)
+        if len(results) > _MAX_PREFIX_VALUES:
+            raise QueryError('More than %d values start with %s' %
+                             (_MAX_PREFIX_VALUES, value))
+        cache.set(mc_key, results)
+        return results
 
     q = _BIndex.all()
     q.filter(' '.join([field, operator]), value)
-    # Uhh, this will someday cause a problem (though probably not in
-    # this app).  Once the size of the results exceeds the size of the
-    # memcahce entry size things are going to start breaking.
     results = q.fetch(1000)
-    memcache.set(mc_key, results)    
-    return _BIndexQuery(results)
+    cache.set(mc_key, results)
+    return results
+
+class QueryError(Exception):
+    """Raised for a query expression that can't be parsed or run."""
+    pass
+
+_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<paren>[()])
+  | (?P<op>!=|<=|>=|\^=|=|<|>)
+  | "(?P<dquoted>(?:[^"\\]|\\.)*)"
+  | '(?P<squoted>(?:[^'\\]|\\.)*)'
+  | (?P<word>[^\s()=!<>^"']+)
+  )""", re.VERBOSE)
+
+_KEYWORDS = ['AND', 'OR', 'NOT']
+
+def _tokenize(expression):
+    """Returns a list of (type, value) tokens.
+
+    type is one of 'paren', 'op', 'keyword', 'word' or 'value' (a
+    quoted string).  Bare words that look like integers are turned into
+    ints."""
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        m = _TOKEN_RE.match(expression, pos)
+        if m is None or m.end() == pos:
+            raise QueryError('Bad query at %d: %s' % (pos, expression))
+        pos = m.end()
+
+        if m.group('paren') is not None:
+            tokens.append(('paren', m.group('paren')))
+        elif m.group('op') is not None:
+            tokens.append(('op', m.group('op')))
+        elif m.group('dquoted') is not None:
+            tokens.append(('value', re.sub(r'\\(.)', r'\1',
+                                           m.group('dquoted'))))
+        elif m.group('squoted') is not None:
+            tokens.append(('value', re.sub(r'\\(.)', r'\1',
+                                           m.group('squoted'))))
+        elif m.group('word') in _KEYWORDS:
+            tokens.append(('keyword', m.group('word')))
+        else:
+            word = m.group('word')
+            try:
+                word = int(word)
+            except ValueError:
+                pass
+            tokens.append(('word', word))
+    return tokens
+
+class _Parser(object):
+    """Recursive descent parser for query expressions.
+
+    expr   := and ('OR' and)*
+    and    := not ('AND' not)*
+    not    := 'NOT' not | '(' expr ')' | field op value
+
+    Produces nested tuples: ('OR', a, b), ('AND', a, b), ('NOT', a)
+    and ('TERM', field, op, value)."""
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def _next(self, type=None):
+        token = self._peek()
+        if token[0] is None or (type is not None and token[0] != type):
+            raise QueryError('Expected %s in query: %s' %
+                             (type or 'more', self.expression))
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        node = self._or()
+        if self.pos != len(self.tokens):
+            raise QueryError('Unexpected %r in query: %s' %
+                             (self._peek()[1], self.expression))
+        return node
+
+    def _or(self):
+        node = self._and()
+        while self._peek() == ('keyword', 'OR'):
+            self.pos += 1
+            node = ('OR', node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() == ('keyword', 'AND'):
+            self.pos += 1
+            node = ('AND', node, self._not())
+        return node
+
+    def _not(self):
+        if self._peek() == ('keyword', 'NOT'):
+            self.pos += 1
+            return ('NOT', self._not())
+        if self._peek() == ('paren', '('):
+            self.pos += 1
+            node = self._or()
+            if self._next('paren') != ')':
+                raise QueryError('Expected ) in query: %s' % self.expression)
+            return node
+
+        field = self._next('word')
+        op = self._next('op')
+        (type, value) = self._peek()
+        if type not in ['word', 'value']:
+            raise QueryError('Expected a value in query: %s' % self.expression)
+        self.pos += 1
+        return ('TERM', field, op, value)
+
+# Merges of sorted posting lists.
+
+def _intersect(a, b):
+    res = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            res.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return res
+
+def _union(a, b):
+    res = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            res.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            res.append(a[i])
+            i += 1
+        else:
+            res.append(b[j])
+            j += 1
+    res.extend(a[i:])
+    res.extend(b[j:])
+    return res
+
+def _difference(a, b):
+    res = []
+    j = 0
+    for posting in a:
+        while j < len(b) and b[j] < posting:
+            j += 1
+        if j == len(b) or b[j] != posting:
+            res.append(posting)
+    return res
+
+def _evaluate(node):
+    """Returns (negated, postings) for a parsed expression.
+
+    negated means the node matches everything *except* postings, which
+    is how NOT is carried up until an AND can turn it into a
+    difference."""
+    if node[0] == 'TERM':
+        (_, field, op, value) = node
+        postings = []
+        for head in _find_heads(field, value, op):
+            postings = _union(postings, list(_iter_postings(head)))
+        return (False, postings)
+
+    if node[0] == 'NOT':
+        (negated, postings) = _evaluate(node[1])
+        return (not negated, postings)
+
+    (a_neg, a) = _evaluate(node[1])
+    (b_neg, b) = _evaluate(node[2])
+    if node[0] == 'AND':
+        if not a_neg and not b_neg:
+            return (False, _intersect(a, b))
+        if not a_neg:
+            return (False, _difference(a, b))
+        if not b_neg:
+            return (False, _difference(b, a))
+        return (True, _union(a, b))
 
+    # OR
+    if not a_neg and not b_neg:
+        return (False, _union(a, b))
+    if not a_neg:
+        return (True, _difference(b, a))
+    if not b_neg:
+        return (True, _difference(a, b))
+    return (True, _intersect(a, b))
+
+def _terms(node):
+    """Returns a list of (field, op, value) for the terms of node."""
+    if node[0] == 'TERM':
+        return [node[1:]]
+    res = []
+    for child in node[1:]:
+        res.extend(_terms(child))
+    return res
+
+class _BIndexExpressionQuery(object):
+    """Results of a query expression, highest order_by value first."""
+    def __init__(self, postings):
+        self.postings = postings
+
+    def count(self):
+        return len(self.postings)
+
+    def fetch(self, limit, offset=0):
+        end = len(self.postings) - offset
+        start = max(0, end - limit)
+        return [_posting_key(p) for p in reversed(self.postings[start:end])]
+
+    def run(self):
+        for posting in reversed(self.postings):
+            yield _posting_key(posting)
+
+    def fetch_page(self, limit, cursor=None):
+        """Returns (keys, next cursor, previous cursor) for a page.
+
+        cursor is one handed back by an earlier call, or None for the
+        first page.  The next cursor is None on the last page.  The
+        previous cursor is None on the first page, and '' on the page
+        after it.  A cursor is just the posting its page starts at, so
+        finding a page is a binary search however deep it is."""
+        end = len(self.postings)
+        if cursor:
+            end = bisect.bisect_right(self.postings, _decode_cursor(cursor))
+        start = max(0, end - limit)
+        keys = [_posting_key(p) for p in reversed(self.postings[start:end])]
+
+        next_cursor = None
+        if start > 0:
+            next_cursor = _encode_cursor(self.postings[start - 1])
+
+        prev_cursor = None
+        if end < len(self.postings):
+            prev_end = end + limit
+            if prev_end >= len(self.postings):
+                prev_cursor = ''
+            else:
+                prev_cursor = _encode_cursor(self.postings[prev_end - 1])
+        return (keys, next_cursor, prev_cursor)
+
+def _encode_cursor(posting):
+    return base64.urlsafe_b64encode(posting)
+
+def _decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor))
+    except (TypeError, UnicodeError):
+        raise QueryError('Bad cursor: %s' % cursor)
+
+def quote(field, value, operator='='):
+    """Builds a query expression term, quoting value as needed."""
+    if isinstance(value, (int, long)):
+        value = str(value)
+    else:
+        value = '"%s"' % re.sub(r'(["\\])', r'\\\1', value)
+    return '%s %s %s' % (field, operator, value)
+
+_NO_VALUE = object()
+
+def query(field, value=_NO_VALUE, operator='='):
+    """Finds the objects indexed with a value.
+
+    Called as query(field, value, operator) this returns everything
+    with field <operator> value, one matching value after another.
+    Besides the datastore's comparisons, the operator can be ^= to
+    match every value that starts with value; that raises QueryError if
+    more than _MAX_PREFIX_VALUES values do.
+
+    Called with just an expression, like
+    'topics = "Arts & Life" AND NOT publish_year = 2010', it combines
+    terms with AND, OR, NOT and parentheses.  Values with spaces need
+    quotes, and bare numbers are ints.  The posting lists are merged in
+    memory and the results come back ordered by the objects' order_by
+    property, highest first."""
+    if value is not _NO_VALUE:
+        return _BIndexQuery(_find_heads(field, value, operator))
+
+    node = _Parser(field).parse()
+    mc_key = cache.generation_key(
+        'bindex_expr:' + hashlib.md5(field.encode('utf-8')).hexdigest(),
+        [_term_generation(term_field, value, op)
+         for (term_field, op, value) in _terms(node)])
+    postings = cache.get(mc_key)
+    if postings is None:
+        (negated, postings) = _evaluate(node)
+        if negated:
+            raise QueryError('Query only excludes things: %s' % field)
+        cache.set(mc_key, postings)
+    return _BIndexExpressionQuery(postings)
+
+
+def _build_summary():
+    """Works out the summary from scratch, by reading every head.
+
+    Only needed when there's no summary record yet."""
+    summary = {}
+    for head in _BIndex.all():
+        if not head.count:
+            continue
+        for prop in head.dynamic_properties():
+            if prop != 'refs':
+                prop_values = summary.setdefault(prop, {})
+                prop_values[head.__getattribute__(prop)] = head.count
+    return summary
+
+def _store_summary(summary):
+    _BIndexSummary(key_name=_SUMMARY_KEY_NAME,
+                   values=db.Blob(pickle.dumps(summary,
+                                               pickle.HIGHEST_PROTOCOL))).put()
+    cache.set(_SUMMARY_CACHE_KEY, summary)
+
+def _create_summary(summary):
+    entity = _BIndexSummary.get_by_key_name(_SUMMARY_KEY_NAME)
+    if entity is not None:
+        # Somebody else got there first
+        return pickle.loads(entity.values)
+    _store_summary(summary)
+    return summary
+
+def _get_summary():
+    summary = cache.get(_SUMMARY_CACHE_KEY)
+    if summary is not None:
+        return summary
+
+    entity = _BIndexSummary.get_by_key_name(_SUMMARY_KEY_NAME)
+    if entity is not None:
+        summary = pickle.loads(entity.values)
+        cache.set(_SUMMARY_CACHE_KEY, summary)
+    else:
+        logging.info('No bindex summary, building one')
+        summary = db.run_in_transaction(_create_summary, _build_summary())
+    return summary
+
+def _update_summary(counts):
+    """Writes a dict of (property, value) -> count into the summary.
+
+    The counts are the heads' own, not changes to them, so a retried
+    update writes the same thing again; and the summary is only written
+    when it differs.  Updates run one at a time (see update()), so no
+    transaction is needed."""
+    if len(counts) == 0:
+        return
+    entity = _BIndexSummary.get_by_key_name(_SUMMARY_KEY_NAME)
+    if entity is None:
+        # The heads are already written, so this includes the counts
+        db.run_in_transaction(_create_summary, _build_summary())
+        return
+
+    summary = pickle.loads(entity.values)
+    changed = False
+    for ((prop, value), count) in counts.items():
+        prop_values = summary.setdefault(prop, {})
+        if prop_values.get(value, 0) == count:
+            continue
+        changed = True
+        if count > 0:
+            prop_values[value] = count
+        else:
+            del prop_values[value]
+    if changed:
+        _store_summary(summary)
 
 class _BIndexListValueReturn(object):
-    def __init__(self, prop, items):
+    def __init__(self, prop, counts):
         self.prop = prop
-        self.items = list(items)
+        self._counts = counts
 
     def list(self):
-        return [i.__getattribute__(self.prop) for i in self.items]
+        return sorted(self._counts.keys())
 
     def counts(self):
-        res = {}
-        for i in self.items:
-            res[i.__getattribute__(self.prop)] = i.count
-        return res
+        return dict(self._counts)
 
 def list_values(property):
-    q = _BIndex.all()
-    q.filter('%s !=' % property, 'NULL')
-    return _BIndexListValueReturn(property, q.run())
+    """Lists the values of property in the index, and their counts."""
+    return facets([property])[property]
 
+def facets(properties):
+    """Like list_values(), for several properties at once.
 
+    Returns a dict of property -> values.  The values and counts of
+    every property are kept in one summary record that's updated as
+    objects are indexed, so this is a single cache (or datastore)
+    lookup however many properties are asked for."""
+    summary = _get_summary()
+    res = {}
+    for prop in properties:
+        res[prop] = _BIndexListValueReturn(prop, summary.get(prop, {}))
+    return res
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""memcache wrapper that can hold values bigger than a memcache entry.
+
+Values are pickled up front.  Small ones are stored under their key as
+is.  Bigger ones are split into chunks stored under their own keys,
+and the key holds a header naming the chunks and the digest of the
+whole value.  A chunked value is read back with a get for the header
+and one get_multi for the chunks, and is treated as a miss if any chunk
+is gone or the digest doesn't match.
+
+Cached values that depend on data which changes can be tagged with
+generations (see generation_key()).  Bumping a generation orphans
+everything cached under the old one, without touching anything else
+in memcache."""
+
+import cPickle as pickle
+import hashlib
+import random
+import time
+
+from google.appengine.api import memcache
+
+# memcache entries max out at 1MB, leave some room for overhead.
+_CHUNK_SIZE = 1000 * 1000 - 1024
+
+# memcache keys max out at 250 bytes.
+_MAX_KEY_LENGTH = 200
+
+_GENERATION_PREFIX = 'generation:'
+
+# The first byte of an entry says what it holds.
+_SINGLE = 's'
+_CHUNKED = 'c'
+
+def _key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    if len(key) > _MAX_KEY_LENGTH:
+        key = 'cache_hash:' + hashlib.sha1(key).hexdigest()
+    return key
+
+def _chunk_keys(key, nonce, count):
+    return ['%s:%s:%d' % (key, nonce, i) for i in range(count)]
+
+def _loads(data):
+    try:
+        return pickle.loads(data)
+    except Exception:
+        return None
+
+def get(key):
+    """Returns the value stored for key, or None."""
+    key = _key(key)
+    entry = memcache.get(key)
+    # Values older code stored straight into memcache under the same
+    # keys aren't entries of ours, so they're just misses.
+    if not isinstance(entry, str) or len(entry) == 0:
+        return None
+
+    if entry[0] == _SINGLE:
+        return _loads(entry[1:])
+    if entry[0] != _CHUNKED:
+        return None
+
+    header = entry[1:].split(':')
+    if len(header) != 3 or not header[1].isdigit():
+        return None
+    (nonce, count, digest) = header
+    chunk_keys = _chunk_keys(key, nonce, int(count))
+    chunks = memcache.get_multi(chunk_keys)
+    if len(chunks) != len(chunk_keys):
+        # Some chunk got evicted
+        return None
+
+    data = ''.join([chunks[k] for k in chunk_keys])
+    if hashlib.md5(data).hexdigest() != digest:
+        return None
+    return pickle.loads(data)
+
+def set(key, value, time=0):
+    """Stores value under key, chunking it if it's too big.
+
+    Returns True if the value was stored."""
+    key = _key(key)
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) < _CHUNK_SIZE:
+        return memcache.set(key, _SINGLE + data, time=time)
+
+    # A new nonce each time means a reader can never mix the chunks of
+    # two different writes.
+    nonce = '%08x' % random.getrandbits(32)
+    count = (len(data) + _CHUNK_SIZE - 1) / _CHUNK_SIZE
+    chunk_keys = _chunk_keys(key, nonce, count)
+    chunks = {}
+    for i in range(count):
+        chunks[chunk_keys[i]] = data[i * _CHUNK_SIZE:(i + 1) * _CHUNK_SIZE]
+
+    # Chunks go in before the header that points at them.
+    if len(memcache.set_multi(chunks, time=time)) != 0:
+        return False
+    header = '%s%s:%d:%s' % (_CHUNKED, nonce, count,
+                             hashlib.md5(data).hexdigest())
+    return memcache.set(key, header, time=time)
+
+def delete(key):
+    """Removes key.  Its chunks (if any) are left to expire."""
+    return memcache.delete(_key(key))
+
+def get_generations(names):
+    """Returns a dict of name -> current generation of each of names."""
+    found = memcache.get_multi(names, key_prefix=_GENERATION_PREFIX)
+    missing = [name for name in names if name not in found]
+    if len(missing) != 0:
+        # Start from the time rather than 0, so a generation that got
+        # evicted can't come back as one that's been used before.
+        now = int(time.time())
+        memcache.add_multi(dict([(name, now) for name in missing]),
+                           key_prefix=_GENERATION_PREFIX)
+        # Somebody else may have got there first
+        found.update(memcache.get_multi(missing,
+                                        key_prefix=_GENERATION_PREFIX))
+        for name in missing:
+            found.setdefault(name, now)
+    return found
+
+def bump_generations(names):
+    """Moves each of names on to a new generation."""
+    if len(names) == 0:
+        return
+    now = int(time.time())
+    current = memcache.get_multi(names, key_prefix=_GENERATION_PREFIX)
+    memcache.set_multi(dict([(name, max(now, current.get(name, 0) + 1))
+                             for name in names]),
+                       key_prefix=_GENERATION_PREFIX)
+
+def generation_key(key, names):
+    """Returns key tagged with the current generation of each of names.
+
+    A value cached under the returned key is never seen again once any
+    of the generations is bumped."""
+    generations = get_generations(names)
+    return '%s@%s' % (key, '.'.join([str(generations[name])
+                                     for name in names]))
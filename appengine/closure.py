@@ -14,34 +14,102 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import StringIO
+import gzip
+import re
+
 from django.utils import simplejson as json
 from google.appengine.ext import webapp
 
+import cache
 import closure_html
 
+_PLACEHOLDER_RE = re.compile(r'{{(page_title|funcname|filename|data)}}')
+
+def _split_template(template):
+    """Splits template into a list of (is_placeholder, text).
+
+    A placeholder's text is its name, the rest is copied as is."""
+    parts = _PLACEHOLDER_RE.split(template)
+    # re.split puts the placeholder names at the odd indexes
+    return [(i % 2 == 1, parts[i]) for i in range(len(parts))
+            if parts[i] != '']
+
+# closure_html.TEMPLATE, split once per instance rather than per request
+_SEGMENTS = _split_template(closure_html.TEMPLATE)
+
 class ClosureHandler(webapp.RequestHandler):
+    # Set to True to gzip pages for clients that accept it
+    compress = False
+
     def __init__(self, title, filename, funcname):
         self.title = title
         self.filename = filename
         self.funcname = funcname
 
-    def _replace_data(self, input, data):
-        input = input.replace('{{page_title}}', self.title)
-        input = input.replace('{{funcname}}', self.funcname)
-        input = input.replace('{{filename}}', self.filename)
-        input = input.replace('{{data}}', data)
-        return input
-
     def get_data(self):
         """Called during render to get data to show."""
         return {'a': 1, 'b': 2}
-        
+
+    @classmethod
+    def _generation(cls):
+        return 'closure:%s.%s' % (cls.__module__, cls.__name__)
+
+    @classmethod
+    def data_changed(cls):
+        """Drops the cached data of this handler class.
+
+        Call this whenever whatever get_data() returns changes."""
+        cache.bump_generations([cls._generation()])
+
+    def _get_json(self):
+        # Generations of different classes can have the same value, so
+        # the class is in the key as well
+        generation = self._generation()
+        key = cache.generation_key('%s:data' % generation, [generation])
+        data = cache.get(key)
+        if data is None:
+            data = self.get_data()
+            if data == None:
+                data = ''
+            else:
+                data = json.dumps(data)
+            cache.set(key, data)
+        return data
+
+    def _write_page(self, out, data):
+        values = {'page_title': self.title,
+                  'funcname': self.funcname,
+                  'filename': self.filename,
+                  'data': data}
+        for (is_placeholder, text) in _SEGMENTS:
+            if is_placeholder:
+                text = values[text]
+                if isinstance(text, unicode):
+                    text = text.encode('utf-8')
+                out.write(text)
+            else:
+                out.write(text)
+
+    def _accepts_gzip(self):
+        encodings = self.request.headers.get('Accept-Encoding', '')
+        return 'gzip' in [encoding.split(';')[0].strip()
+                          for encoding in encodings.split(',')]
+
     def get(self):
-        data = self.get_data()
-        if data == None:
-            data = ''
-        else:
-            data = json.dumps(data)
+        data = self._get_json()
+        if not self.compress:
+            self._write_page(self.response.out, data)
+            return
 
-        self.response.out.write(self._replace_data(closure_html.TEMPLATE, data))
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if not self._accepts_gzip():
+            self._write_page(self.response.out, data)
+            return
 
+        buf = StringIO.StringIO()
+        out = gzip.GzipFile(mode='wb', fileobj=buf)
+        self._write_page(out, data)
+        out.close()
+        self.response.headers['Content-Encoding'] = 'gzip'
+        self.response.out.write(buf.getvalue())
@@ -14,39 +14,109 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
-"""Config objects to control the web app."""
+"""Config objects to control the web app.
 
+Nothing is read when this module is imported.  The first get() of any
+config loads every value at once (from memcache, or with one datastore
+multi-get), and they're kept in memory for _TTL_SEC.  Values changed
+with set() are seen straight away by this instance, and by the others
+within _TTL_SEC; so are values edited in the datastore viewer."""
+
+import logging
+import time
+
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
+# How long values are trusted, both in memory and in memcache.
+_TTL_SEC = 60
+
+_MEMCACHE_KEY = 'config_values'
+
 class _TextConfig(db.Model):
     """Data store object to contain the config."""
     last_modified_date = db.DateTimeProperty(auto_now=True)
     date_added = db.DateTimeProperty(auto_now_add=True)    
     value = db.StringProperty()
 
-# TODO(napier): need some way to set things
-
-class _StringConfig(object):
+# name -> config object, for every config defined below
+_configs = {}
+
+# name -> value (a string) of every config, and when they were loaded
+_values = None
+_loaded_at = 0
+
+def _load_values():
+    values = memcache.get(_MEMCACHE_KEY)
+    if values is not None:
+        return values
+
+    names = sorted(_configs.keys())
+    values = {}
+    for (name, entity) in zip(names, _TextConfig.get_by_key_name(names)):
+        if entity is None:
+            entity = _configs[name]._get_or_insert()
+        values[name] = entity.value
+
+    memcache.set(_MEMCACHE_KEY, values, time=_TTL_SEC)
+    return values
+
+def _get_values():
+    global _values, _loaded_at
+    now = time.time()
+    if _values is None or now - _loaded_at > _TTL_SEC:
+        _values = _load_values()
+        _loaded_at = now
+    return _values
+
+def invalidate():
+    """Drops the cached values, so the next get() reloads them."""
+    global _values
+    _values = None
+    memcache.delete(_MEMCACHE_KEY)
+
+class _Config(object):
+    def __init__(self, name, default_value):
+        self.name = name
+        self.default_value = str(default_value)
+        _configs[name] = self
+
+    def _get_or_insert(self):
+        # Doesn't overwrite a value set since it was found missing
+        logging.info('Storing default for config %s' % self.name)
+        return _TextConfig.get_or_insert(self.name, value=self.default_value)
+
+    def get_string(self):
+        values = _get_values()
+        if self.name not in values:
+            # Loaded by an instance that didn't have this config yet
+            values[self.name] = self._get_or_insert().value
+        return values[self.name]
+
+    def set(self, value):
+        _TextConfig(key_name=self.name, value=str(value)).put()
+        invalidate()
+
+class _StringConfig(_Config):
     def __init__(self, name, default_value=''):
-        self.value = _TextConfig.get_or_insert(name, value=default_value)
+        _Config.__init__(self, name, default_value)
 
     def get(self):
-        return self.value.value
+        return self.get_string()
 
-class _IntConfig(object):
+class _IntConfig(_Config):
     def __init__(self, name, default_value=0):
-        self.value = _TextConfig.get_or_insert(name, value=str(default_value))
+        _Config.__init__(self, name, default_value)
 
     def get(self):
-        return int(self.value.value)
+        return int(self.get_string())
 
-class _BoolConfig(object):
+class _BoolConfig(_Config):
     def __init__(self, name, default_value=False):
-        self.value = _TextConfig.get_or_insert(name, value=str(default_value))
+        _Config.__init__(self, name, default_value)
 
     def get(self):
-        return self.value.value == 'True'
-
+        return self.get_string() == 'True'
 
 # The API Key to pass to NPR api server
 NPR_API_KEY = _StringConfig('npr_api_key', '')
@@ -77,6 +147,11 @@ AUTO_FETCH_STORIES = _BoolConfig('auto_fetch_stories', True)
 # seconds)
 AUTO_FETCH_DELAY_SEC = _IntConfig('auto_fetch_delay_sec', 30)
 
+# The number of fetch chains a backfill (/backend/fetch_all?backfill=True)
+# runs side by side.  The rate they actually run at is capped by the
+# backfill-queue in queue.yaml.
+BACKFILL_WINDOWS = _IntConfig('backfill_windows', 10)
+
 RECENT_STORIES_COUNT = _IntConfig('recent_stories_count', 10)
 
 # The number of stories to get from the datastore to hand to each
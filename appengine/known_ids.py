@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Compact index of the story ids that have already been stored.
+
+Ids are grouped into buckets by dropping their last few digits.  NPR
+hands out ids roughly in order, so a page of API results usually lands
+in one or two buckets and can be resolved with a single memcache
+get_multi (or a single datastore multi-get when memcache is cold).
+
+Each id also carries the digest of the XML stored for it (if known) so
+a force refresh can tell which stories actually changed without
+reading them back."""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# Number of trailing characters of an id dropped to find its bucket.
+_BUCKET_DIGITS = 4
+
+_MEMCACHE_PREFIX = 'known_ids:'
+
+class _KnownIdBucket(db.Model):
+    # Comma separated list of id:digest pairs.  Kept as text so it
+    # isn't indexed.
+    ids = db.TextProperty()
+
+def _bucket_name(id):
+    return id[:-_BUCKET_DIGITS] or '0'
+
+def _decode_ids(text):
+    if not text:
+        return {}
+    res = {}
+    for entry in text.split(','):
+        (id, _, digest) = entry.partition(':')
+        res[id] = digest or None
+    return res
+
+def _encode_ids(ids):
+    return db.Text(','.join(['%s:%s' % (id, ids[id] or '')
+                             for id in sorted(ids)]))
+
+def _group_by_bucket(ids):
+    buckets = {}
+    for id in ids:
+        buckets.setdefault(_bucket_name(id), []).append(id)
+    return buckets
+
+def _get_buckets(names):
+    """Returns a dict of bucket name -> dict of id -> digest."""
+    found = memcache.get_multi(names, key_prefix=_MEMCACHE_PREFIX)
+
+    missing = [name for name in names if name not in found]
+    if len(missing) != 0:
+        loaded = {}
+        entities = _KnownIdBucket.get_by_key_name(missing)
+        for (name, entity) in zip(missing, entities):
+            if entity is None:
+                loaded[name] = {}
+            else:
+                loaded[name] = _decode_ids(entity.ids)
+        memcache.set_multi(loaded, key_prefix=_MEMCACHE_PREFIX)
+        found.update(loaded)
+
+    return found
+
+def get_digests(ids):
+    """Returns a dict of id -> digest for the ids that are in the index.
+
+    The digest is None for ids stored before digests were recorded."""
+    buckets = _get_buckets(_group_by_bucket(ids).keys())
+    res = {}
+    for id in ids:
+        bucket = buckets[_bucket_name(id)]
+        if id in bucket:
+            res[id] = bucket[id]
+    return res
+
+def find_known(ids):
+    """Returns the subset of ids that are in the index."""
+    return set(get_digests(ids).keys())
+
+def _add_to_bucket(name, digests):
+    entity = _KnownIdBucket.get_by_key_name(name)
+    if entity is None:
+        entity = _KnownIdBucket(key_name=name)
+    known = _decode_ids(entity.ids)
+
+    changed = False
+    for (id, digest) in digests.items():
+        if id not in known or (digest is not None and known[id] != digest):
+            known[id] = digest
+            changed = True
+
+    if changed:
+        entity.ids = _encode_ids(known)
+        entity.put()
+
+def add(digests):
+    """Records ids as stored.
+
+    digests is either a dict of id -> digest of the stored XML, or a
+    list of ids whose digest isn't known.  A missing digest never
+    overwrites a known one."""
+    if not isinstance(digests, dict):
+        digests = dict([(id, None) for id in digests])
+
+    buckets = _group_by_bucket(digests.keys())
+    for (name, bucket_ids) in buckets.items():
+        # Tasks can run in parallel, so each bucket is updated in its
+        # own transaction.
+        db.run_in_transaction(_add_to_bucket, name,
+                              dict([(id, digests[id]) for id in bucket_ids]))
+
+    if len(buckets) != 0:
+        logging.info('Added %d ids to the known id index' % len(digests))
+        # Drop (rather than set) the cached copies so a racing task
+        # can't leave a stale bucket behind.
+        memcache.delete_multi(buckets.keys(), key_prefix=_MEMCACHE_PREFIX)
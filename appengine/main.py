@@ -25,23 +25,89 @@ import urllib
 from google.appengine.dist import use_library
 use_library('django', '1.2')
     
+from google.appengine.api import memcache
+from google.appengine.ext import db
 from google.appengine.ext import webapp
-from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 
 import bindex
-import closure
 import config
 import model
+import page_cache
 import queries
 
 _MONTHS = map(lambda x: datetime(year=1990, month=x, day=1).strftime("%B"),
               range(1, 13))
 
+# The facets listed in the sidebar
+_FACETS = ['column', 'collection', 'topics', 'publish_year']
+
+# The query parameters the home page reads
+_LISTING_PARAMS = ['topic', 'year', 'month', 'collection', 'column', 'cursor']
+
+# Every template a page is rendered from
+_TEMPLATES = ['main.html', 'story.html', 'story_header_snippet.html']
+
+_STORY_HEADER_PREFIX = 'story_header:'
+
+def _template_path(name):
+    return os.path.join(os.path.dirname(__file__), 'templates', name)
+
+def _render(path, params):
+    # The template module pulls in all of Django, so it isn't
+    # imported until something is actually rendered (or warmed up).
+    from google.appengine.ext.webapp import template
+    return template.render(path, params)
+
+def _story_header_key(story):
+    # A deploy can change the snippet, so the version is part of the key
+    modified = ''
+    if story.last_modified_date != None:
+        modified = story.last_modified_date.isoformat()
+    return '%s:%s:%s' % (os.environ.get('CURRENT_VERSION_ID', ''),
+                         story.id, modified)
+
+def _render_story_headers(stories):
+    """Returns the rendered story_header_snippet.html for each story.
+
+    Rendered snippets are cached per story and last modified date, so
+    only stories that are new (or changed) since they were last shown
+    get rendered."""
+    # Imported late for the same reason as in _render()
+    from django.template import Context
+    from google.appengine.ext.webapp import template
+
+    keys = [_story_header_key(story) for story in stories]
+    headers = memcache.get_multi(keys, key_prefix=_STORY_HEADER_PREFIX)
+
+    rendered = {}
+    snippet = None
+    for (key, story) in zip(keys, stories):
+        if key not in headers and key not in rendered:
+            if snippet is None:
+                # webapp keeps the compiled template around
+                snippet = template.load(
+                    _template_path('story_header_snippet.html'))
+            rendered[key] = snippet.render(Context(dict(story=story)))
+    if len(rendered) != 0:
+        memcache.set_multi(rendered, key_prefix=_STORY_HEADER_PREFIX)
+        headers.update(rendered)
+
+    return [headers[key] for key in keys]
+
 def _build_page_title(subtitle):
     return 'Fresh Air - %s' % subtitle
 
-def _get_default_template_params(req, overrides):
+def _known_params(req, params):
+    """Returns the values of params that req has (see page_cache.cached())."""
+    query_params = {}
+    for arg in params:
+        value = req.get(arg, None)
+        if value:
+            query_params[arg] = value.encode('utf-8')
+    return query_params
+
+def _get_default_template_params(req, params, overrides):
     if config.JS_COMPILED.get():
         js_compiled='_compiled'
     else:
@@ -51,7 +117,12 @@ def _get_default_template_params(req, overrides):
     home_url = urlunparse([parsed_url.scheme,
                            parsed_url.netloc,
                            '', '', '', ''])
-    overrides.update(dict(canonical_url=req.url,
+    canonical_url = urlunparse([parsed_url.scheme,
+                                parsed_url.netloc,
+                                parsed_url.path, '',
+                                urllib.urlencode(_known_params(req, params)),
+                                ''])
+    overrides.update(dict(canonical_url=canonical_url,
                           js_compiled=js_compiled,
                           home_url=home_url))
     return overrides
@@ -59,11 +130,9 @@ def _get_default_template_params(req, overrides):
 class FilterWrapper(object):
     def __init__(self, name, arg_name, req):
         self.name = name
-        query_params = {}
-        for arg in req.arguments():
-            value = req.get(arg, None)
-            if value != None:
-                query_params[arg] = value
+        query_params = _known_params(req, _LISTING_PARAMS)
+        # Changing the filters starts over from the first page
+        query_params.pop('cursor', None)
 
         # Overwrite any old value with the new one
         query_params[arg_name] = name           
@@ -76,41 +145,76 @@ class FilterWrapper(object):
                                '', '', q, ''])        
         
 
+def _page_url(req, cursor):
+    """Returns the URL of the page of the current listing at cursor."""
+    query_params = _known_params(req, _LISTING_PARAMS)
+    query_params.pop('cursor', None)
+    if cursor:
+        query_params['cursor'] = cursor
+
+    q = urllib.urlencode(query_params)
+    parsed_url = urlparse(req.url)
+    return urlunparse([parsed_url.scheme,
+                       parsed_url.netloc,
+                       '', '', q, ''])
+
 class MainPage(webapp.RequestHandler):
+    @page_cache.cached(_LISTING_PARAMS)
     def get(self):
+        facets = bindex.facets(_FACETS)
         columns = [FilterWrapper(i, 'column', self.request) for i
-                   in bindex.list_values('column').list()]
+                   in facets['column'].list()]
         collections = [FilterWrapper(i, 'collection', self.request) for i
-                       in bindex.list_values('collection').list()]
+                       in facets['collection'].list()]
         topics = [FilterWrapper(i, 'topic', self.request) for i
-                  in bindex.list_values('topics').list()]
+                  in facets['topics'].list()]
         years = [FilterWrapper(i, 'year', self.request) for i
-                 in bindex.list_values('publish_year').list()]
+                 in facets['publish_year'].list()]
         
-        path = os.path.join(os.path.dirname(__file__),
-                            'templates', 'main.html')
+        path = _template_path('main.html')
+
+        # parse arguments
+        topic = self.request.get('topic', None) or None
+        year = self.request.get('year', None) or None
+        collection = self.request.get('collection', None) or None
+        column = self.request.get('column', None) or None
+        month = self.request.get('month', None) or None
+        cursor = self.request.get('cursor', None) or None
 
-        if len(self.request.arguments()) == 0:
+        if [topic, year, collection, column, month] == [None] * 5:
             # Stories are recent stories
-            stories = queries.get_recent_stories(config.RECENT_STORIES_COUNT.get())
+            count = config.RECENT_STORIES_COUNT.get()
         else:
-            # parse arguments
-            topic = self.request.get('topic', None)
-            year = self.request.get('year', None)            
-            collection = self.request.get('collection', None)
-            month = self.request.get('month', None)
+            count = 10
+        filters = dict(topic=topic, year=year, collection=collection,
+                       column=column, month=month, count=count)
+        try:
+            listing = queries.get_story_listing(cursor=cursor, **filters)
+        except (bindex.QueryError, db.BadValueError, db.BadRequestError,
+                ValueError), e:
+            if cursor is None:
+                raise
+            # A cursor that's been mangled, or is from before the stories
+            # changed too much to carry on from it: start over
+            logging.info('Bad cursor %s: %s' % (cursor, e))
+            listing = queries.get_story_listing(**filters)
 
-            stories = queries.get_stories_with_filter(topic=topic,
-                                                      year=year,
-                                                      collection=collection,
-                                                      month=month)
+        next_url = None
+        if listing.next_cursor != None:
+            next_url = _page_url(self.request, listing.next_cursor)
+        prev_url = None
+        if listing.prev_cursor != None:
+            prev_url = _page_url(self.request, listing.prev_cursor)
 
         months = [FilterWrapper(i, 'month', self.request) for i in _MONTHS]
         
-        self.response.out.write(template.render(path,
+        self.response.out.write(_render(path,
                                                 _get_default_template_params(self.request,
+                                                                             _LISTING_PARAMS,
                                                                              dict(page_title='Fresh Air',
-                                                                                  stories=stories,
+                                                                                  story_headers=_render_story_headers(listing.stories),
+                                                                                  next_url=next_url,
+                                                                                  prev_url=prev_url,
                                                                                   columns=columns,
                                                                                   collections=collections,
                                                                                   topics=topics,
@@ -119,9 +223,10 @@ class MainPage(webapp.RequestHandler):
                                                                                   ))))
         
 class StoryPage(webapp.RequestHandler):
+    @page_cache.cached(['id'])
     def get(self):
         id = self.request.get('id', None)
-        if id is None:
+        if not id:
             logging.error('Got request missing parameters: %s' % id)
             self.error(404)
             return
@@ -133,15 +238,32 @@ class StoryPage(webapp.RequestHandler):
             return
         
         page_title = _build_page_title(story.title)
-        path = os.path.join(os.path.dirname(__file__),
-                            'templates', 'story.html')        
-        self.response.out.write(template.render(path,
+        path = _template_path('story.html')
+        self.response.out.write(_render(path,
                                                 _get_default_template_params(self.request,
+                                                                             ['id'],
                                                                              dict(story=story,
                                                                                   page_title=page_title))))
     
+class WarmupHandler(webapp.RequestHandler):
+    """Gets a new instance ready before it's sent any real requests.
+
+    Loads the config, compiles the templates (webapp caches them) and
+    makes sure the home page's story listing and facets are cached."""
+    def get(self):
+        from google.appengine.ext.webapp import template
+        for name in _TEMPLATES:
+            template.load(_template_path(name))
+
+        queries.get_story_listing(count=config.RECENT_STORIES_COUNT.get())
+        bindex.facets(_FACETS)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('OK')
+
 application = webapp.WSGIApplication([('/', MainPage),
                                       ('/story', StoryPage),
+                                      ('/_ah/warmup', WarmupHandler),
                                       ],
                                      debug=True)
 
@@ -16,6 +16,8 @@
 
 """Data storage model classes."""
 
+import zlib
+
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
 
@@ -46,9 +48,48 @@ class StoryBase(polymodel.PolyModel):
     # This may be a dupe of the key, but easier to get at
     id = db.StringProperty()
 
+# Values for FullStory.xml_format
+XML_FORMAT_TEXT = 0
+XML_FORMAT_ZLIB = 1
+
 class FullStory(StoryBase):
-    """The unmparsed XML."""
+    """The unmparsed XML.
+
+    Use get_xml() and set_xml() rather than the properties.  Stories
+    are stored zlib compressed in compressed_xml, but ones stored
+    before that still have plain text in xml until they're migrated
+    (see /backend/compress_xml)."""
+    xml_format = db.IntegerProperty(default=XML_FORMAT_TEXT)
     xml = db.TextProperty()
+    compressed_xml = db.BlobProperty()
+
+    # Hex SHA-1 of the XML, used to skip rewriting unchanged stories.
+    xml_digest = db.StringProperty(indexed=False)
+
+    def get_xml(self):
+        """Returns the XML as a UTF-8 str, decompressing it on first use.
+
+        ElementTree can't parse unicode with non-ASCII characters in
+        it, so this never hands back unicode."""
+        if self.xml_format != XML_FORMAT_ZLIB:
+            if self.xml is None:
+                return None
+            return self.xml.encode('utf-8')
+
+        xml = getattr(self, '_decompressed_xml', None)
+        if xml is None:
+            xml = zlib.decompress(self.compressed_xml)
+            self._decompressed_xml = xml
+        return xml
+
+    def set_xml(self, xml):
+        """Stores xml (unicode, or a UTF-8 str) compressed."""
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        self.compressed_xml = db.Blob(zlib.compress(xml))
+        self.xml = None
+        self.xml_format = XML_FORMAT_ZLIB
+        self._decompressed_xml = None
 
 # The class hierarcy here is kinda odd.  A typical hierarch would look
 # like this:
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Whole page cache for the public pages.
+
+Pages only change when new stories are ingested, so a rendered page is
+cached under its host, path and the values of the query parameters its
+handler reads, along with the content generation it was rendered in.
+Any other parameters are ignored, so they can't fill the cache with
+copies of the same page.  The host stays in the key since pages link
+back to it.  The generation is the time
+the current content started (see cache.get_generations()), and the
+backend moves it on with content_changed() whenever it parses stories.
+
+Cached pages are served with an ETag and a Last-Modified of the
+generation, so browsers and crawlers that ask again with
+If-None-Match/If-Modified-Since get a 304."""
+
+import email.Utils
+import hashlib
+import urllib
+
+import cache
+
+_GENERATION = 'pages'
+
+def get_generation():
+    """Returns the current content generation (a unix time)."""
+    return cache.get_generations([_GENERATION])[_GENERATION]
+
+def content_changed():
+    """Starts a new generation, so every page gets rendered again."""
+    cache.bump_generations([_GENERATION])
+
+def _page_key(request, params, generation):
+    values = []
+    for name in params:
+        value = request.get(name, '')
+        if value != '':
+            values.append((name, value.encode('utf-8')))
+    return 'page:%d:%s%s?%s' % (generation, request.host.lower(),
+                                request.path, urllib.urlencode(values))
+
+def _not_modified(request, etag, generation):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        since = email.Utils.parsedate_tz(if_modified_since)
+        if since is not None:
+            return email.Utils.mktime_tz(since) >= generation
+    return False
+
+def _send(handler, page, generation):
+    (content_type, etag, body) = page
+    response = handler.response
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = email.Utils.formatdate(generation,
+                                                               usegmt=True)
+    response.clear()
+    if _not_modified(handler.request, etag, generation):
+        response.set_status(304)
+        return
+    response.headers['Content-Type'] = content_type
+    response.out.write(body)
+
+def cached(params):
+    """Decorator for a RequestHandler's get() that caches its page.
+
+    params lists every query parameter the page depends on; the page
+    must not depend on any others.  An empty value is the same as a
+    missing one.  Only successful responses are cached; errors and
+    redirects are rendered every time."""
+    def decorator(method):
+        def wrapper(self):
+            generation = get_generation()
+            key = _page_key(self.request, params, generation)
+            page = cache.get(key)
+            if page is None:
+                method(self)
+                if (self.response.status != 200 or
+                    'Location' in self.response.headers):
+                    return
+                body = self.response.out.getvalue()
+                if isinstance(body, unicode):
+                    body = body.encode('utf-8')
+                page = (self.response.headers['Content-Type'],
+                        '"%s"' % hashlib.md5(body).hexdigest(),
+                        body)
+                cache.set(key, page)
+            _send(self, page, generation)
+        return wrapper
+    return decorator
@@ -14,31 +14,88 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
-from google.appengine.api import memcache
+from google.appengine.ext import db
 
 from datetime import datetime
 
+import bindex
+import cache
 import model
+import search
+
+# Cache generation for anything that lists stories without a filter.
+_LISTING_GENERATION = 'listing'
+
+def _story_generation(id):
+    return 'story:' + str(id)
+
+def stories_changed(ids):
+    """Drops cached results that the stories with ids could be in.
+
+    Filtered results are tagged with bindex generations, which bindex
+    bumps itself when the stories are indexed."""
+    cache.bump_generations([_LISTING_GENERATION] +
+                           [_story_generation(id) for id in ids])
+
+class StorySummary(object):
+    """Just what a listing shows of a story.
+
+    Listings are cached as lists of these rather than as model
+    instances, which are far bigger to store and slower to unpickle.
+    The properties match the ones the templates use on StoryPreview."""
+    def __init__(self, id, title, publish_date, thumbnail, teaser,
+                 topics, column, collection, last_modified_date=None):
+        self.id = id
+        self.last_modified_date = last_modified_date
+        self.title = title
+        self.publish_date = publish_date
+        self.preferred_thumbnail = thumbnail
+        self.preferred_teaser = teaser
+        self.all_topics = topics
+        self.column = column
+        self.collection = collection
+
+    @classmethod
+    def from_preview(cls, preview):
+        return cls(preview.id, preview.title, preview.publish_date,
+                   preview.preferred_thumbnail, preview.preferred_teaser,
+                   preview.all_topics, preview.column, preview.collection,
+                   preview.last_modified_date)
+
+    def to_record(self):
+        return (self.id, self.title, self.publish_date,
+                self.preferred_thumbnail, self.preferred_teaser,
+                self.all_topics, self.column, self.collection,
+                self.last_modified_date)
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(*record)
+
+    @property
+    def has_thumbnail(self):
+        return self.preferred_thumbnail != None
+
+    @property
+    def has_teaser(self):
+        return self.preferred_teaser != ''
+
+    @property
+    def has_column(self):
+        return self.column != None
+
+    @property
+    def has_collection(self):
+        return self.collection != None
 
 def get_recent_stories(count):
-    mc_key = 'recent_stories:' + str(count)
-    results = memcache.get(mc_key)
-    if results != None:
-        return results
-    
-    # TODO(napier): memcache
-    q = model.StoryPreview.all()
-    q.order('-publish_date')
-
-    # TODO(napier): figure out how to change to run instead and then
-    # truncate the iterable (should be async)
-    results = q.fetch(limit=count)
-    memcache.set(mc_key, results)
-    return results
+    """Returns a list of StorySummary for the newest count stories."""
+    return get_story_listing(count=count).stories
 
 def get_story_by_id(id):
-    mc_key = 'story_by_id:' + str(id)
-    results = memcache.get(mc_key)
+    mc_key = cache.generation_key('story_by_id:' + str(id),
+                                  [_story_generation(id)])
+    results = cache.get(mc_key)
     if results != None:
         return results
     
@@ -46,9 +103,45 @@ def get_story_by_id(id):
     q.filter('id =', id)
     # Only one, so use get
     results = q.get()
-    memcache.set(mc_key, results)
+    cache.set(mc_key, results)
     return results    
 
+def _preview_key(id):
+    full_story_key = db.Key.from_path(model.FullStory.kind(), id)
+    return db.Key.from_path(model.StoryPreview.kind(), id,
+                            parent=full_story_key)
+
+def get_stories_by_ids(ids, full=False):
+    """Returns a list of the stories with ids, None for any that don't exist.
+
+    Stories are StorySummary, or the whole Story if full is True.
+    However many ids there are it's one cache lookup, and one datastore
+    get on a miss."""
+    ids = [str(id) for id in ids]
+    mc_key = cache.generation_key(
+        'stories_by_ids:%s:%s' % (full, ','.join(ids)),
+        [_story_generation(id) for id in ids])
+    results = cache.get(mc_key)
+    if results != None:
+        if not full:
+            results = [record and StorySummary.from_record(record)
+                       for record in results]
+        return results
+
+    keys = [_preview_key(id) for id in ids]
+    if full:
+        # The Story is a child of its preview, with the same key name
+        keys = [db.Key.from_path(model.Story.kind(), id, parent=key)
+                for (id, key) in zip(ids, keys)]
+        results = db.get(keys)
+        cache.set(mc_key, results)
+    else:
+        results = [preview and StorySummary.from_preview(preview)
+                   for preview in db.get(keys)]
+        cache.set(mc_key, [summary and summary.to_record()
+                           for summary in results])
+    return results
+
 _MONTHS = map(lambda x: datetime(year=1990, month=x, day=1).strftime("%B"),
               range(1, 13))
 
@@ -58,31 +151,167 @@ def _month_to_monum(month):
             return x + 1
     return 0
 
-def get_stories_with_filter(topic=None,
-                            year=None,
-                            month=None,
-                            collection=None,
-                            count=10):
-
-    mc_key = ':'.join([x for x in ['stories_with_filter', topic, year,
-                           month, collection, str(count)] if x != None])
-    results = memcache.get(mc_key)
-    if results != None:
-        return results
-    
-    q = model.Story.all()
-    q.order('-publish_date')
+def _build_filter_terms(topic, year, month, collection, column):
+    """Returns a list of (field, value) that stories have to match."""
+    terms = []
     if topic != None:
         # Need to figure out how to handle primary topic
-        q.filter('topics =', topic)
+        terms.append(('topics', topic))
     if collection != None:
-        q.filter('collection =', collection)
+        terms.append(('collection', collection))
+    if column != None:
+        terms.append(('column', column))
 
     if year != None and month == None:
-        q.filter('publish_year =', int(year))
+        terms.append(('publish_year', int(year)))
     if year != None and month != None:
         yearmo = (int(year) * 100) + _month_to_monum(month)
-        q.filter('publish_yearmonth =', yearmo)        
+        terms.append(('publish_yearmonth', yearmo))
+    return terms
+
+def _build_filter_query(terms):
+    return ' AND '.join([bindex.quote(field, value)
+                         for (field, value) in terms])
+
+class StoryListing(object):
+    """A page of stories, and cursors for the pages either side of it.
+
+    next_cursor is None on the last page.  prev_cursor is None on the
+    first page, and '' on the page right after it."""
+    def __init__(self, stories, next_cursor, prev_cursor):
+        self.stories = stories
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __getstate__(self):
+        # One compact record per story, rather than a pickled object
+        return ([story.to_record() for story in self.stories],
+                self.next_cursor, self.prev_cursor)
+
+    def __setstate__(self, state):
+        (records, self.next_cursor, self.prev_cursor) = state
+        self.stories = [StorySummary.from_record(record)
+                        for record in records]
+
+def _listing_key(prefix, count, cursor, generations, **filters):
+    parts = [prefix, str(count)]
+    for name in sorted(filters.keys()):
+        if filters[name] != None:
+            parts.append('%s=%s' % (name, filters[name]))
+    parts.append(cursor or '')
+    return cache.generation_key(':'.join(parts), generations)
+
+def _fetch_page(q, count, cursor, note_key):
+    """Returns (results, next_cursor, prev_cursor) for a page of q.
+
+    Datastore cursors only go forwards, so each page leaves a note for
+    the one after it saying where it started.  note_key(cursor) is the
+    cache key of the note for the page at cursor."""
+    if cursor:
+        q.with_cursor(cursor)
     results = q.fetch(count)
-    memcache.set(mc_key, results)
-    return results 
+
+    next_cursor = None
+    if len(results) == count:
+        next_cursor = q.cursor()
+
+    prev_cursor = None
+    if cursor:
+        prev_cursor = cache.get(note_key(cursor))
+    if next_cursor != None:
+        cache.set(note_key(next_cursor), cursor or '')
+    return (results, next_cursor, prev_cursor)
+
+def get_story_listing(topic=None,
+                      year=None,
+                      month=None,
+                      collection=None,
+                      column=None,
+                      count=10,
+                      cursor=None):
+    """Returns a StoryListing of stories matching the filters, newest first.
+
+    The listing holds a StorySummary for each story, built from
+    StoryPreviews alone.
+
+    cursor is one of the cursors from an earlier listing with the same
+    filters and count, or None for the first page."""
+    terms = _build_filter_terms(topic, year, month, collection, column)
+    if len(terms) == 0:
+        generations = [_LISTING_GENERATION]
+    else:
+        generations = [bindex.generation_name(field, value)
+                       for (field, value) in terms]
+
+    filters = dict(topic=topic, year=year, month=month,
+                   collection=collection, column=column)
+    mc_key = _listing_key('story_listing', count, cursor, generations,
+                          **filters)
+    results = cache.get(mc_key)
+    if results != None:
+        return results
+
+    if len(terms) == 0:
+        # No filters at all, so everything matches
+        q = model.StoryPreview.all()
+        q.order('-publish_date')
+        (previews, next_cursor, prev_cursor) = _fetch_page(
+            q, count, cursor,
+            lambda c: _listing_key('story_listing_prev', count, c,
+                                   generations, **filters))
+    else:
+        # The filters are answered from the bindex (which holds
+        # previews, newest first) rather than a composite index per
+        # combination of filters.
+        expression = _build_filter_query(terms)
+        (keys, next_cursor, prev_cursor) = bindex.query(
+            expression).fetch_page(count, cursor)
+        previews = [preview for preview in db.get(keys) if preview != None]
+
+    results = StoryListing([StorySummary.from_preview(preview)
+                            for preview in previews],
+                           next_cursor, prev_cursor)
+    cache.set(mc_key, results)
+    return results
+
+def search_stories(text, count=10, cursor=None):
+    """Returns a StoryListing of the stories with every word in text.
+
+    Stories come newest first.  See search for what counts as a word.
+    cursor works the same as for get_story_listing()."""
+    terms = search.get_terms(text)
+    if len(terms) == 0:
+        return StoryListing([], None, None)
+
+    # Listings show more of a story than its words
+    generations = [_LISTING_GENERATION, search.GENERATION]
+    query = ' '.join(terms)
+    mc_key = _listing_key('search', count, cursor, generations, q=query)
+    results = cache.get(mc_key)
+    if results != None:
+        return results
+
+    (keys, next_cursor, prev_cursor) = _fetch_page(
+        search.build_query(terms), count, cursor,
+        lambda c: _listing_key('search_prev', count, c, generations,
+                               q=query))
+    previews = [preview for preview
+                in db.get([_preview_key(search.story_id(key))
+                           for key in keys])
+                if preview != None]
+    results = StoryListing([StorySummary.from_preview(preview)
+                            for preview in previews],
+                           next_cursor, prev_cursor)
+    cache.set(mc_key, results)
+    return results
+
+def get_stories_with_filter(topic=None,
+                            year=None,
+                            month=None,
+                            collection=None,
+                            column=None,
+                            count=10):
+    """Returns a list of StorySummary for the newest matching stories."""
+    return get_story_listing(topic=topic, year=year, month=month,
+                             collection=collection, column=column,
+                             count=count).stories
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""JSON API over the stories.
+
+  /rest/stories?ids=1,2,3     The stories with those ids, in order
+                              (null for ids that don't exist).
+  /rest/listing?topic=...     A page of stories matching the filters,
+                              newest first, the same way the home page
+                              lists them.  Takes topic, year, month,
+                              collection, column, count and cursor.
+  /rest/facets                The values of each facet, and how many
+                              stories have each.
+  /rest/search?q=...          A page of the stories with every word in
+                              q, newest first.  Takes count and cursor.
+
+Stories are previews unless view=full is given, and fields=a,b,c cuts
+each story down to just those fields.  Responses come from the same
+caches as the pages do (see page_cache), and carry an ETag so a client
+can ask again with If-None-Match."""
+
+import datetime
+import logging
+import re
+
+from google.appengine.dist import use_library
+use_library('django', '1.2')
+
+from django.utils import simplejson as json
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+import bindex
+import page_cache
+import queries
+
+_FACETS = ['column', 'collection', 'topics', 'publish_year']
+
+# The fields in each view, and the attribute of the story each comes from
+_PREVIEW_FIELDS = [('id', 'id'),
+                   ('title', 'title'),
+                   ('publish_date', 'publish_date'),
+                   ('thumbnail', 'preferred_thumbnail'),
+                   ('teaser', 'preferred_teaser'),
+                   ('topics', 'all_topics'),
+                   ('column', 'column'),
+                   ('collection', 'collection')]
+_FULL_FIELDS = _PREVIEW_FIELDS + [('story_date', 'story_date'),
+                                  ('primary_topic', 'primary_topic'),
+                                  ('story_url', 'story_url'),
+                                  ('text', 'text'),
+                                  ('text_with_html', 'text_with_html')]
+
+# Every query parameter any of the handlers reads
+_PARAMS = ['ids', 'q', 'topic', 'year', 'month', 'collection', 'column',
+           'view', 'fields', 'count', 'cursor']
+
+_ID_RE = re.compile(r'[0-9]+$')
+
+_MAX_IDS = 100
+_MAX_COUNT = 100
+_DEFAULT_COUNT = 10
+
+class _BadRequest(Exception):
+    pass
+
+def _to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def _story_to_json(story, fields):
+    if story is None:
+        return None
+    res = {}
+    for (name, attr) in fields:
+        res[name] = _to_json_value(getattr(story, attr))
+    return res
+
+def _parse_int(value, default, maximum):
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise _BadRequest('Not a number: %s' % value)
+    if value < 1 or value > maximum:
+        raise _BadRequest('Out of range (1-%d): %d' % (maximum, value))
+    return value
+
+class _RestHandler(webapp.RequestHandler):
+    """Base class of the handlers.
+
+    Subclasses implement _handle(), which returns the response to the
+    request as an object to send as JSON.  It raises _BadRequest if the
+    request's parameters are no good, which is sent back as a 400."""
+    def _get_fields(self, full_allowed):
+        view = self.request.get('view', '') or 'preview'
+        if view == 'preview':
+            fields = _PREVIEW_FIELDS
+        elif view == 'full' and full_allowed:
+            fields = _FULL_FIELDS
+        else:
+            raise _BadRequest('Unknown view: %s' % view)
+
+        names = self.request.get('fields', '')
+        if names == '':
+            return (view == 'full', fields)
+        names = names.split(',')
+        known = dict(fields)
+        for name in names:
+            if name not in known:
+                raise _BadRequest('Unknown field: %s' % name)
+        return (view == 'full', [(name, known[name]) for name in names])
+
+    def _write_json(self, obj):
+        self.response.headers['Content-Type'] = (
+            'application/json; charset=utf-8')
+        self.response.out.write(json.dumps(obj, separators=(',', ':')))
+
+    @page_cache.cached(_PARAMS)
+    def get(self):
+        try:
+            self._write_json(self._handle())
+        except _BadRequest, e:
+            # The message can quote unicode parameters, which str(e) chokes on
+            message = e.args[0]
+            logging.info('Bad REST request %s: %s' % (self.request.url,
+                                                      message))
+            self.response.set_status(400)
+            self._write_json(dict(error=message))
+
+class StoriesHandler(_RestHandler):
+    def _handle(self):
+        ids = [id for id in self.request.get('ids', '').split(',') if id]
+        if len(ids) == 0 or len(ids) > _MAX_IDS:
+            raise _BadRequest('Need 1-%d ids' % _MAX_IDS)
+        for id in ids:
+            if not _ID_RE.match(id):
+                raise _BadRequest('Not a story id: %s' % id)
+        (full, fields) = self._get_fields(True)
+        stories = queries.get_stories_by_ids(ids, full=full)
+        return dict(stories=[_story_to_json(story, fields)
+                             for story in stories])
+
+class ListingHandler(_RestHandler):
+    def _handle(self):
+        # Listings are built from previews only
+        (full, fields) = self._get_fields(False)
+        count = _parse_int(self.request.get('count', None), _DEFAULT_COUNT,
+                           _MAX_COUNT)
+        filters = {}
+        for name in ['topic', 'year', 'month', 'collection', 'column']:
+            filters[name] = self.request.get(name, None) or None
+        try:
+            listing = queries.get_story_listing(
+                count=count, cursor=self.request.get('cursor', None) or None,
+                **filters)
+        except (bindex.QueryError, db.BadValueError, db.BadRequestError,
+                ValueError), e:
+            raise _BadRequest(str(e))
+        return dict(stories=[_story_to_json(story, fields)
+                             for story in listing.stories],
+                    next_cursor=listing.next_cursor,
+                    prev_cursor=listing.prev_cursor)
+
+class SearchHandler(_RestHandler):
+    def _handle(self):
+        (full, fields) = self._get_fields(False)
+        count = _parse_int(self.request.get('count', None), _DEFAULT_COUNT,
+                           _MAX_COUNT)
+        try:
+            listing = queries.search_stories(
+                self.request.get('q', ''), count=count,
+                cursor=self.request.get('cursor', None) or None)
+        except (db.BadValueError, db.BadRequestError), e:
+            raise _BadRequest(str(e))
+        return dict(stories=[_story_to_json(story, fields)
+                             for story in listing.stories],
+                    next_cursor=listing.next_cursor,
+                    prev_cursor=listing.prev_cursor)
+
+class FacetsHandler(_RestHandler):
+    def _handle(self):
+        facets = bindex.facets(_FACETS)
+        res = {}
+        for name in _FACETS:
+            counts = facets[name].counts()
+            res[name] = [dict(value=value, count=counts[value])
+                         for value in facets[name].list()]
+        return res
+
+application = webapp.WSGIApplication([('/rest/stories', StoriesHandler),
+                                      ('/rest/listing', ListingHandler),
+                                      ('/rest/facets', FacetsHandler),
+                                      ('/rest/search', SearchHandler),
+                                      ],
+                                     debug=True)
+
+def main():
+    run_wsgi_app(application)
+
+if __name__ == "__main__":
+    main()
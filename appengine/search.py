@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Full text search over the stories.
+
+Every story gets one _StoryWords entity listing the words in its title,
+teasers and text, plus a 'prefix*' entry for the first few letters of
+each word.  A search is a datastore query with an equality filter on
+words for each search word, which the datastore answers by merging its
+built-in index on words, so there's no composite index to build and
+indexing a story is a single put.  The entity's key name starts with a
+token that sorts newer stories first, so results come back newest first
+in key order.
+
+Words are runs of letters and digits, lowercased.  There's no stemming;
+a search word ending in * matches every word starting with it, though
+only its first _MAX_PREFIX_LENGTH letters are compared."""
+
+import calendar
+import re
+
+from google.appengine.ext import db
+
+import cache
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Words too common to be worth indexing
+_STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'had', 'has', 'have', 'he', 'her', 'his', 'i', 'in', 'is', 'it', 'its',
+    'of', 'on', 'or', 's', 'she', 'so', 't', 'that', 'the', 'their', 'they',
+    'this', 'to', 'was', 'were', 'with', 'you'])
+
+# Prefixes shorter than this would match too many words
+_MIN_PREFIX_LENGTH = 2
+
+# Longer prefixes aren't stored, to keep the number of index rows a
+# story costs down.
+_MAX_PREFIX_LENGTH = 5
+
+# Most words and prefixes stored for a story.  Each one costs two index
+# rows (ascending and descending), and an entity can only have 5000, so
+# a put of a long transcript would fail without a cap.  Words from the
+# title and teasers come first, then the text's in order, then the
+# prefixes, shortest first; whatever is past the cap isn't searchable.
+_MAX_VALUES = 2000
+
+# The first parser version whose stories were indexed here.  Older ones
+# were never indexed, so they're indexed from scratch.
+_FIRST_INDEXED_VERSION = 3
+
+# Stories without a publish date sort after every other story.
+_MAX_TIME = 10 ** 10
+
+# Cache generation bumped whenever any story's words change.
+GENERATION = 'search'
+
+class _StoryWords(db.Model):
+    """The searchable words of a story.
+
+    The key name is '<recency token>:<story id>' (see _key_name())."""
+    words = db.StringListProperty()
+
+def get_words(text):
+    """Returns the set of indexable words in text."""
+    if not text:
+        return set()
+    return set([word for word in _WORD_RE.findall(text.lower())
+                if word not in _STOP_WORDS])
+
+def _prefix(word):
+    return word[:_MAX_PREFIX_LENGTH] + '*'
+
+def _story_words(story):
+    """Returns the sorted words and prefixes stored for a Story.
+
+    There are at most _MAX_VALUES of them."""
+    words = []
+    seen = set()
+    for text in [story.title, story.short_teaser, story.teaser,
+                 story.text]:
+        if not text:
+            continue
+        for word in _WORD_RE.findall(text.lower()):
+            if word not in _STOP_WORDS and word not in seen:
+                seen.add(word)
+                words.append(word)
+    values = set(words[:_MAX_VALUES])
+    for length in range(_MIN_PREFIX_LENGTH, _MAX_PREFIX_LENGTH + 1):
+        for word in words:
+            if len(values) >= _MAX_VALUES:
+                return sorted(values)
+            if len(word) >= length:
+                values.add(_prefix(word[:length]))
+    return sorted(values)
+
+def _key_name(story):
+    time = 0
+    if story.publish_date is not None:
+        time = calendar.timegm(story.publish_date.utctimetuple())
+    return '%010d:%s' % (_MAX_TIME - time, story.id)
+
+def story_id(key):
+    """Returns the id of the story a search result key is for."""
+    return key.name().split(':', 1)[1]
+
+def update(changes):
+    """Brings the search index up to date with changed stories.
+
+    changes is a list of (old, new) Story pairs, like bindex.update()
+    takes.  Each story's words are written in one go, and only for
+    stories whose words (or publish date) changed, so reparsing an
+    unchanged story writes nothing."""
+    to_put = []
+    to_delete = []
+    for (old, new) in changes:
+        if (old is not None and
+            (old.xml_parser_version or 0) < _FIRST_INDEXED_VERSION):
+            old = None
+        new_key_name = None
+        if new is not None:
+            new_key_name = _key_name(new)
+            words = _story_words(new)
+            if (old is None or _key_name(old) != new_key_name or
+                _story_words(old) != words):
+                to_put.append(_StoryWords(key_name=new_key_name,
+                                          words=words))
+        if old is not None and _key_name(old) != new_key_name:
+            to_delete.append(db.Key.from_path(_StoryWords.kind(),
+                                              _key_name(old)))
+
+    if len(to_put) != 0:
+        db.put(to_put)
+    if len(to_delete) != 0:
+        db.delete(to_delete)
+    if len(to_put) != 0 or len(to_delete) != 0:
+        cache.bump_generations([GENERATION])
+
+def get_terms(text):
+    """Returns the sorted words (and prefixes) a search for text matches.
+
+    Every one of them has to match."""
+    terms = []
+    for word in text.lower().split():
+        words = _WORD_RE.findall(word)
+        if (word.endswith('*') and len(words) != 0 and
+            len(words[-1]) >= _MIN_PREFIX_LENGTH):
+            terms.append(_prefix(words.pop()))
+        terms.extend([w for w in words if w not in _STOP_WORDS])
+    return sorted(set(terms))
+
+def build_query(terms):
+    """Returns a keys only query for the stories with every one of terms.
+
+    terms come from get_terms().  Results are _StoryWords keys (see
+    story_id()), newest story first."""
+    q = _StoryWords.all(keys_only=True)
+    for term in terms:
+        q.filter('words =', term)
+    q.order('__key__')
+    return q
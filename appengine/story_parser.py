@@ -14,15 +14,18 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
-import time
 from datetime import datetime
 from datetime import tzinfo
 from datetime import timedelta
-import xml.etree.ElementTree as et
+try:
+    # Much faster, where it's available
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
 
 import model
 
-_XML_PARSER_VERSION = 1
+_XML_PARSER_VERSION = 3
 
 ZERO = timedelta(0)
 class FixedOffset(tzinfo):
@@ -41,33 +44,52 @@ class FixedOffset(tzinfo):
     def dst(self, dt):
         return ZERO
 
-# who would have thought this would have been so much work
-def _parse_into_datetime(input):
-    # Pull out GMT offset
-    gmt_offset = input[-5:]
-    gmt_sign = gmt_offset[0]
-    gmt_offset = gmt_offset[1:]
-    gmt_offset_minute = int(gmt_offset[-2:])
-    gmt_offset_hour = int(gmt_offset[:-2])
+# Every story carries one of a handful of offsets, so share the tzinfo
+# objects rather than building two new ones per story.
+_TIMEZONES = {}
+
+def _get_timezone(gmt_offset):
+    """Returns the tzinfo for an offset like '-0400'."""
+    tz = _TIMEZONES.get(gmt_offset)
+    if tz is None:
+        # Make GMT sign into a +1 or -1
+        gmt_sign = int(gmt_offset[0] + '1')
+        minutes = int(gmt_offset[1:-2]) * 60 + int(gmt_offset[-2:])
+        tz = FixedOffset(minutes * gmt_sign, name=gmt_offset[1:])
+        _TIMEZONES[gmt_offset] = tz
+    return tz
+
+_MONTHS = dict([(name, number + 1) for (number, name) in
+                enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])])
 
-    # Make GMT sign into a +1 or -1
-    gmt_sign = int(gmt_sign + '1')
+# who would have thought this would have been so much work
+def _parse_into_datetime_slow(input):
+    input = input.strip()
+    tz = _get_timezone(input[-5:])
 
     # Adjust input
     input = input[:-5].rstrip().lstrip()
-
-    tz = FixedOffset(((gmt_offset_hour * 60) + gmt_offset_minute) * gmt_sign,
-                     name=gmt_offset)
-
     dt = datetime.strptime(input, '%a, %d %b %Y %H:%M:%S')
+    return dt.replace(tzinfo=tz)
 
-    return datetime(year=dt.year,
-                    month=dt.month,
-                    day=dt.day,
-                    hour=dt.hour,
-                    minute=dt.minute,
-                    second=dt.second,
-                    tzinfo=tz)    
+def _parse_into_datetime(input):
+    """Parses an RFC 822 date like 'Thu, 23 Jun 2011 11:02:04 -0400'.
+
+    The API always sends them in exactly this shape, so pick it apart by
+    hand; strptime is slow.  Anything unexpected goes the slow way."""
+    parts = input.split()
+    if len(parts) == 6 and parts[2] in _MONTHS:
+        (_, day, month, year, clock, gmt_offset) = parts
+        clock = clock.split(':')
+        if len(clock) == 3 and len(gmt_offset) == 5:
+            try:
+                return datetime(int(year), _MONTHS[month], int(day),
+                                int(clock[0]), int(clock[1]), int(clock[2]),
+                                tzinfo=_get_timezone(gmt_offset))
+            except ValueError:
+                pass
+    return _parse_into_datetime_slow(input)
 
 def _parse_datetime_into_year(dt):
     return dt.year
@@ -76,37 +98,45 @@ def _parse_datetime_into_yearmonth(dt):
     # This code will break in appox 8000 years. I think we'll be OK
     return (dt.year * 100) + dt.month
 
-def parse_full_story(full_story_xml, full_story):
-    story = et.fromstring(full_story_xml)
-    id = story.attrib['id']    
-    title = story.find('title').text
-    
-    story_date = _parse_into_datetime(story.find('storyDate').text)
-    story_year = _parse_datetime_into_year(story_date)
-    story_yearmonth = _parse_datetime_into_yearmonth(story_date)
-    
-    pub_date = _parse_into_datetime(story.find('pubDate').text)
-    pub_year = _parse_datetime_into_year(pub_date)
-    pub_yearmonth = _parse_datetime_into_yearmonth(pub_date)
-
-    thumbnail_large = story.find('thumbnail/large')
-    if thumbnail_large is not None:
-        thumbnail_large = thumbnail_large.text
-    thumbnail_medium = story.find('thumbnail/medium')
-    if thumbnail_medium is not None:
-        thumbnail_medium = thumbnail_medium.text    
-    thumbnail_small = story.find('thuombnail/small')
-    if thumbnail_small is not None:
-        thumbnail_small = thumbnail_small.text
-
-    teaser = story.find('teaser').text
-    short_teaser = story.find('miniTeaser').text
+def _text(element):
+    if element is None:
+        return None
+    return element.text
+
+def _paragraphs(element):
+    """Returns the text of each <paragraph> under element, one per line."""
+    if element is None:
+        return u''
+    return u'\n'.join([paragraph.text or u''
+                       for paragraph in element.findall('paragraph')])
+
+def _parse_fields(story):
+    """Returns a dict of the properties shared by StoryPreview and Story."""
+    # Walk the story's children once instead of find()ing each one
+    children = {}
+    links = []
+    parents = []
+    for child in story:
+        if child.tag == 'link':
+            links.append(child)
+        elif child.tag == 'parent':
+            parents.append(child)
+        elif child.tag not in children:
+            children[child.tag] = child
+
+    story_date = _parse_into_datetime(children['storyDate'].text)
+    pub_date = _parse_into_datetime(children['pubDate'].text)
+
+    thumbnails = {}
+    thumbnail = children.get('thumbnail')
+    if thumbnail is not None:
+        for size in thumbnail:
+            thumbnails.setdefault(size.tag, size.text)
 
     story_url = ''
-    for link in story.findall('link'):
+    for link in links:
         if link.attrib['type'] == 'html':
             story_url = link.text
-            
 
     # Parse parents into topics and stuff
     collection = None
@@ -114,7 +144,7 @@ def parse_full_story(full_story_xml, full_story):
     primary_topic = None
     column = None
     
-    for parent in story.findall('parent'):
+    for parent in parents:
         type = parent.attrib['type']
         value = parent.find('title').text
         if 'topic' == type:
@@ -126,50 +156,45 @@ def parse_full_story(full_story_xml, full_story):
         if 'primaryTopic' == type:
             primary_topic = value
 
-    preview = model.StoryPreview(key_name=id,
-                                 parent=full_story,
-                                 id=id,
-                                 title=title,
-                                 story_date=story_date,
-                                 story_year=story_year,
-                                 story_yearmonth=story_yearmonth,
-                                 publish_date=pub_date,
-                                 publish_year=pub_year,
-                                 publish_yearmonth=pub_yearmonth,
-                                 thumbnail_large = thumbnail_large,
-                                 thumbnail_medium = thumbnail_medium,
-                                 thumbnail_small = thumbnail_small,
-                                 teaser=teaser,
-                                 short_teaser=short_teaser,
-                                 collection=collection,
-                                 column=column,
-                                 primary_topic=primary_topic,
-                                 topics=list(topics),
-                                 story_url=story_url,
-                                 xml_parser_version=_XML_PARSER_VERSION)
-    parsed_story = model.Story(key_name=id,
-                               parent=preview,                               
-                               id=id,
-                               title=title,
-                               story_date=story_date,
-                               story_year=story_year,
-                               story_yearmonth=story_yearmonth,
-                               publish_date=pub_date,
-                               publish_year=pub_year,
-                               publish_yearmonth=pub_yearmonth,
-                               thumbnail_large = thumbnail_large,
-                               thumbnail_medium = thumbnail_medium,
-                               thumbnail_small = thumbnail_small,
-                               teaser=teaser,
-                               short_teaser=short_teaser,
-                               collection=collection,
-                               column=column,
-                               primary_topic=primary_topic,
-                               topics=list(topics),
-                               story_url=story_url,                               
-                               # TODO(napier): fill these out
-                               text='',
-                               text_with_html='',
-                               xml_parser_version=_XML_PARSER_VERSION)
-
-    return (preview, parsed_story)
+    id = story.attrib['id']
+    return dict(key_name=id,
+                id=id,
+                title=_text(children.get('title')),
+                story_date=story_date,
+                story_year=_parse_datetime_into_year(story_date),
+                story_yearmonth=_parse_datetime_into_yearmonth(story_date),
+                publish_date=pub_date,
+                publish_year=_parse_datetime_into_year(pub_date),
+                publish_yearmonth=_parse_datetime_into_yearmonth(pub_date),
+                thumbnail_large=thumbnails.get('large'),
+                thumbnail_medium=thumbnails.get('medium'),
+                thumbnail_small=thumbnails.get('small'),
+                teaser=_text(children.get('teaser')),
+                short_teaser=_text(children.get('miniTeaser')),
+                collection=collection,
+                column=column,
+                primary_topic=primary_topic,
+                topics=list(topics),
+                story_url=story_url,
+                xml_parser_version=_XML_PARSER_VERSION)
+
+def parse_full_story(full_story_xml, full_story):
+    return parse_full_stories([(full_story_xml, full_story)])[0]
+
+def parse_full_stories(stories):
+    """Parses a list of (full story xml, FullStory) pairs.
+
+    Returns a list of (StoryPreview, Story) pairs, in the same order."""
+    res = []
+    for (full_story_xml, full_story) in stories:
+        doc = et.fromstring(full_story_xml)
+        fields = _parse_fields(doc)
+        preview = model.StoryPreview(parent=full_story, **fields)
+        # Only the Story gets the body, previews stay small
+        parsed_story = model.Story(
+            parent=preview,
+            text=_paragraphs(doc.find('text')),
+            text_with_html=_paragraphs(doc.find('textWithHtml')),
+            **fields)
+        res.append((preview, parsed_story))
+    return res
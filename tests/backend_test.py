@@ -14,6 +14,7 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import StringIO
 import unittest
 
 import test_setup
@@ -40,6 +41,13 @@ class FakeResponse(object):
     def __init__(self):
         self.headers = {}
         self.out = FakeResponseOut()
+        self.status = 200
+
+    def set_status(self, status):
+        self.status = status
+
+class DeadlineError(Exception):
+    pass
 
 class TestBackend(unittest.TestCase):
     def setUp(self):
@@ -47,6 +55,7 @@ class TestBackend(unittest.TestCase):
         self.testbed.setup_env(app_id='npr-fresh-air')
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()                
+        self.testbed.init_memcache_stub()
         self.testbed.init_taskqueue_stub(_all_queues_valid=True)
 
     def testIncremenalTest(self):
@@ -66,5 +75,259 @@ class TestBackend(unittest.TestCase):
         fetch_queue = taskqueue_stub.GetTasks('fetch-queue')
         self.assertEquals(1, len(fetch_queue))
 
+    def testBackfill(self):
+        import backend
+        import config
+
+        req = FakeRequest(dict(force='False', backfill='True'))
+        resp = FakeResponse()
+
+        fetch_all = backend.FetchAll()
+        fetch_all.initialize(req, resp)
+        fetch_all.get()
+
+        taskqueue_stub = self.testbed.get_stub('taskqueue')
+
+        # One task per window, and nothing on the incremental queue
+        backfill_queue = taskqueue_stub.GetTasks('backfill-queue')
+        self.assertEquals(config.BACKFILL_WINDOWS.get(), len(backfill_queue))
+        fetch_queue = taskqueue_stub.GetTasks('fetch-queue')
+        self.assertEquals(0, len(fetch_queue))
+
+    def testBackfillEnd(self):
+        import backend
+
+        backend._set_backfill_end('run', 81)
+        self.assertEquals(81, backend._get_backfill_end('run'))
+
+        # A later window can only move the end earlier
+        backend._set_backfill_end('run', 121)
+        self.assertEquals(81, backend._get_backfill_end('run'))
+        backend._set_backfill_end('run', 61)
+        self.assertEquals(61, backend._get_backfill_end('run'))
+
+    def _fetch_window(self, page):
+        import backend
+
+        old_open_url = backend._open_url
+        if page is None:
+            backend._open_url = lambda url: None
+        else:
+            backend._open_url = lambda url: StringIO.StringIO(page)
+        try:
+            req = FakeRequest(dict(offset='21', count='20', run='run',
+                                   stride='200', force='False'))
+            resp = FakeResponse()
+            fetch_xml = backend.FetchXml()
+            fetch_xml.initialize(req, resp)
+            fetch_xml.post()
+        finally:
+            backend._open_url = old_open_url
+        taskqueue_stub = self.testbed.get_stub('taskqueue')
+        return (resp.status, taskqueue_stub.GetTasks('backfill-queue'))
+
+    def testFetchXml_fetchFails(self):
+        # Failed, so the queue retries this window rather than moving on
+        (status, tasks) = self._fetch_window(None)
+        self.assertEquals(500, status)
+        self.assertEquals([], tasks)
+
+    def testFetchXml_noStories(self):
+        # An API error that isn't the end of the stories
+        page = ('<?xml version="1.0" encoding="UTF-8"?><nprml>'
+                '<message id="300" level="error"><text>Bad API key'
+                '</text></message></nprml>')
+        (status, tasks) = self._fetch_window(page)
+        self.assertEquals(200, status)
+        self.assertEquals([], tasks)
+
+    def testIterStories(self):
+        import backend
+
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        story_xml = story_xml[story_xml.index('?>') + 2:]
+        page = ''.join(['<?xml version="1.0" encoding="UTF-8"?><nprml><list>',
+                        story_xml,
+                        story_xml.replace('137378586', '137378587'),
+                        '</list></nprml>'])
+
+        # Tiny reads, so tags get split across them
+        old_read_size = backend._READ_SIZE
+        backend._READ_SIZE = 5
+        try:
+            stories = list(backend._iter_stories(StringIO.StringIO(page)))
+        finally:
+            backend._READ_SIZE = old_read_size
+        self.assertEquals(['137378586', '137378587'],
+                          [id for (id, xml) in stories])
+        self.assertEquals(story_xml.strip(), stories[0][1])
+
+        end_page = ('<?xml version="1.0" encoding="UTF-8"?><nprml>'
+                    '<message id="401" level="warning"><text>No results'
+                    '</text></message></nprml>')
+        self.assertRaises(backend.NoMoreStories, list,
+                          backend._iter_stories(StringIO.StringIO(end_page)))
+
+    def testParseXml(self):
+        import backend
+        import model
+        import queries
+
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        full_story = model.FullStory(key_name='137378586', id='137378586')
+        full_story.set_xml(story_xml)
+        full_story.put()
+
+        req = FakeRequest(dict(ids='137378586,1'))
+        parse_xml = backend.ParseXml()
+        parse_xml.initialize(req, FakeResponse())
+        parse_xml.post()
+
+        stories = queries.get_stories_with_filter(topic='Movies', year='2011')
+        self.assertEquals(['137378586'], [story.id for story in stories])
+        self.assertEquals('Movie Reviews', stories[0].column)
+        self.assertTrue(stories[0].has_thumbnail)
+
+        # And again, from the cache
+        stories = queries.get_stories_with_filter(topic='Movies', year='2011')
+        self.assertEquals(['137378586'], [story.id for story in stories])
+        self.assertEquals(['Arts & Life', 'Movies'],
+                          sorted(stories[0].all_topics))
+
+        stories = queries.get_stories_with_filter(topic='Movies', year='2010')
+        self.assertEquals([], stories)
+
+        stories = queries.search_stories('bad teacher').stories
+        self.assertEquals(['137378586'], [story.id for story in stories])
+
+        stories = queries.get_stories_by_ids(['1', '137378586'])
+        self.assertEquals(None, stories[0])
+        self.assertEquals('Movie Reviews', stories[1].column)
+        stories = queries.get_stories_by_ids(['137378586'], full=True)
+        self.assertEquals('Movie Reviews', stories[0].column)
+        self.assertTrue(stories[0].story_url != None)
+        # And again, from the cache
+        stories = queries.get_stories_by_ids(['1', '137378586'])
+        self.assertEquals([None, '137378586'],
+                          [story and story.id for story in stories])
+
+    def testParseXml_retried(self):
+        import backend
+        import bindex
+        import model
+        import queries
+
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        full_story = model.FullStory(key_name='137378586', id='137378586')
+        full_story.set_xml(story_xml)
+        full_story.put()
+
+        # The first attempt dies part way through
+        old_update = bindex.update
+        def failing_update(*args, **kwargs):
+            raise DeadlineError()
+        bindex.update = failing_update
+        try:
+            parse_xml = backend.ParseXml()
+            parse_xml.initialize(FakeRequest(dict(ids='137378586')),
+                                 FakeResponse())
+            self.assertRaises(DeadlineError, parse_xml.post)
+        finally:
+            bindex.update = old_update
+
+        parse_xml = backend.ParseXml()
+        parse_xml.initialize(FakeRequest(dict(ids='137378586')),
+                             FakeResponse())
+        parse_xml.post()
+
+        stories = queries.get_stories_with_filter(topic='Movies')
+        self.assertEquals(['137378586'], [story.id for story in stories])
+        self.assertEquals({'Movies': 1, 'Arts & Life': 1},
+                          bindex.list_values('topics').counts())
+
+    def testParseXml_searchRetried(self):
+        import backend
+        import model
+        import queries
+        import search
+
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        full_story = model.FullStory(key_name='137378586', id='137378586')
+        full_story.set_xml(story_xml)
+        full_story.put()
+
+        old_update = search.update
+        def failing_update(changes):
+            raise DeadlineError()
+        search.update = failing_update
+        try:
+            parse_xml = backend.ParseXml()
+            parse_xml.initialize(FakeRequest(dict(ids='137378586')),
+                                 FakeResponse())
+            self.assertRaises(DeadlineError, parse_xml.post)
+        finally:
+            search.update = old_update
+
+        parse_xml = backend.ParseXml()
+        parse_xml.initialize(FakeRequest(dict(ids='137378586')),
+                             FakeResponse())
+        parse_xml.post()
+
+        stories = queries.search_stories('bad teacher').stories
+        self.assertEquals(['137378586'], [story.id for story in stories])
+
+    def testCompressXml(self):
+        import backend
+        import model
+
+        model.FullStory(key_name='1', id='1', xml=u'<story id="1"/>').put()
+        model.FullStory(key_name='2', id='2').put()
+
+        compress_xml = backend.CompressXml()
+        compress_xml.initialize(FakeRequest(dict(task='True')),
+                                FakeResponse())
+        compress_xml.post()
+
+        (compressed, empty) = model.FullStory.get_by_key_name(['1', '2'])
+        self.assertEquals(model.XML_FORMAT_ZLIB, compressed.xml_format)
+        self.assertEquals('<story id="1"/>', compressed.get_xml())
+        self.assertEquals(model.XML_FORMAT_TEXT, empty.xml_format)
+
+    def testFindStaleIds(self):
+        import backend
+        import model
+        import story_parser
+
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        for id in ['137378586', '1']:
+            full_story = model.FullStory(key_name=id, id=id)
+            full_story.set_xml(story_xml)
+            full_story.put()
+
+        parse_xml = backend.ParseXml()
+        parse_xml.initialize(FakeRequest(dict(ids='137378586')),
+                             FakeResponse())
+        parse_xml.post()
+
+        self.assertEquals(['1'], backend._find_stale_ids(['137378586', '1']))
+
+        old_version = story_parser._XML_PARSER_VERSION
+        story_parser._XML_PARSER_VERSION = old_version + 1
+        try:
+            self.assertEquals(['137378586', '1'],
+                              backend._find_stale_ids(['137378586', '1']))
+        finally:
+            story_parser._XML_PARSER_VERSION = old_version
+
 if __name__ == '__main__':
     test_setup.main('backend')
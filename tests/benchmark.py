@@ -0,0 +1,307 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Benchmarks for the ingestion hot paths.  Run the same way as the
+# tests, optionally with the number of stories to ingest:
+#
+#   python tests/benchmark.py <appengine sdk path> appengine [stories]
+#
+# The micro benchmarks time single functions.  The ingestion benchmark
+# builds a synthetic corpus out of tests/story.xml, serves it from a
+# local fake of the NPR API, and runs it through story_parser, bindex,
+# FetchXml and ParseXml against the testbed stubs, reporting
+# stories/sec, RPCs per service call and the process' peak memory.
+
+import BaseHTTPServer
+import StringIO
+import cgi
+import datetime
+import logging
+import re
+import resource
+import sys
+import threading
+import time
+import urlparse
+import xml.etree.ElementTree as et
+
+import test_setup
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+# The API maxes out at 20 stories per page.
+_PAGE_SIZE = 20
+_ITERATIONS = 50
+
+_CORPUS_SIZE = 200
+if len(sys.argv) > 3:
+    _CORPUS_SIZE = int(sys.argv[3])
+
+def _new_testbed():
+    bed = testbed.Testbed()
+    bed.setup_env(app_id='npr-fresh-air')
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(_all_queues_valid=True)
+    bed.init_urlfetch_stub()
+    return bed
+
+def _load_story():
+    fp = open('tests/story.xml')
+    story_xml = fp.read()
+    fp.close()
+    # Drop the <?xml?> declaration so stories can be concatenated
+    return story_xml[story_xml.index('?>') + 2:]
+
+def _build_page(stories):
+    return ''.join(['<?xml version="1.0" encoding="UTF-8"?>',
+                    '<nprml version="0.93"><list>'] +
+                   stories +
+                   ['</list></nprml>'])
+
+_END_PAGE = ('<?xml version="1.0" encoding="UTF-8"?><nprml version="0.93">'
+             '<message id="401" level="warning"><text>No results</text>'
+             '</message></nprml>')
+
+def _tree_ingest(page):
+    # How FetchXml used to split up a page: build the whole tree, then
+    # serialize each story back out to store it.
+    doc = et.fromstring(page)
+    return [(story.attrib['id'], et.tostring(story))
+            for story in doc.findall('list/story')]
+
+def _stream_ingest(page):
+    import backend
+    return list(backend._iter_stories(StringIO.StringIO(page)))
+
+def _time(func, arg):
+    start = time.time()
+    for i in range(_ITERATIONS):
+        func(arg)
+    return (time.time() - start) / _ITERATIONS
+
+def bench_split_page():
+    page = _build_page([_load_story()] * _PAGE_SIZE)
+    tree = _time(_tree_ingest, page)
+    stream = _time(_stream_ingest, page)
+    print 'split %d story page (%d bytes)' % (_PAGE_SIZE, len(page))
+    print '  tree + tostring: %8.2f ms/page' % (tree * 1000)
+    print '  streaming:       %8.2f ms/page (%.1fx)' % (stream * 1000,
+                                                       tree / stream)
+
+def bench_parse_dates():
+    import story_parser
+    dates = ['Thu, 23 Jun 2011 11:02:04 -0400'] * 1000
+    slow = _time(lambda d: map(story_parser._parse_into_datetime_slow, d),
+                 dates)
+    fast = _time(lambda d: map(story_parser._parse_into_datetime, d), dates)
+    print 'parse %d dates' % len(dates)
+    print '  strptime:        %8.2f ms (%.1f us/date)' % (
+        slow * 1000, slow * 1000 * 1000 / len(dates))
+    print '  fast path:       %8.2f ms (%.1f us/date, %.1fx)' % (
+        fast * 1000, fast * 1000 * 1000 / len(dates), slow / fast)
+
+def bench_parse_stories():
+    import model
+    import story_parser
+    story_xml = '<?xml version="1.0" encoding="UTF-8"?>' + _load_story()
+    stories = [(story_xml, model.FullStory(key_name=str(n), id=str(n)))
+               for n in range(_PAGE_SIZE)]
+    batch = _time(story_parser.parse_full_stories, stories)
+    print 'parse %d stories' % len(stories)
+    print '  parse_full_stories: %5.2f ms (%.2f ms/story)' % (
+        batch * 1000, batch * 1000 / len(stories))
+
+# The synthetic corpus.  Every story is tests/story.xml with its own
+# id, a date a day older than the one before it, and one of a handful
+# of topics and columns, so the index sees a realistic spread.
+_TEMPLATE_ID = '137378586'
+_FIRST_ID = 200000000
+_DATE_RE = re.compile(r'<(storyDate|pubDate)>[^<]*</(storyDate|pubDate)>')
+_TOPICS = ['Arts & Life', 'Books', 'Music', 'Television', 'Politics',
+           'Health', 'Science', 'Comedy', 'Theater', 'Film']
+_COLUMNS = ['Movie Reviews', 'Book Reviews', 'Music Reviews',
+            'Music Interviews', 'Author Interviews']
+
+def _make_corpus(count):
+    """Returns a list of (id, xml), newest first, like the API."""
+    template = _load_story()
+    newest = datetime.datetime(2011, 6, 24, 11, 0, 0)
+    corpus = []
+    for n in range(count):
+        id = str(_FIRST_ID + n)
+        when = newest - datetime.timedelta(days=n, minutes=n % 60)
+        when = when.strftime('%a, %d %b %Y %H:%M:%S -0400')
+        story = template.replace(_TEMPLATE_ID, id)
+        story = _DATE_RE.sub(lambda m: '<%s>%s</%s>' % (m.group(1), when,
+                                                         m.group(1)),
+                             story)
+        story = story.replace(
+            '<title>Arts &amp; Life</title>',
+            '<title>%s</title>' % cgi.escape(_TOPICS[n % len(_TOPICS)]))
+        story = story.replace(
+            '<title>Movie Reviews</title>',
+            '<title>%s</title>' % _COLUMNS[n % len(_COLUMNS)])
+        corpus.append((id, story))
+    return corpus
+
+class _FakeApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves pages of the corpus the way the NPR query API does."""
+    corpus = []
+
+    def do_GET(self):
+        query = cgi.parse_qs(urlparse.urlparse(self.path)[4])
+        # The API counts from 1
+        start = int(query['startNum'][0]) - 1
+        count = int(query['numResults'][0])
+        stories = self.corpus[start:start + count]
+        if len(stories) == 0:
+            body = _END_PAGE
+        else:
+            body = _build_page([story for (id, story) in stories])
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _start_fake_api(corpus):
+    """Starts the fake API server and returns its host:port."""
+    _FakeApiHandler.corpus = corpus
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _FakeApiHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return '127.0.0.1:%d' % server.server_address[1]
+
+class _RpcCounter(object):
+    """Counts API calls by service.call, via a pre-call hook."""
+    def __init__(self):
+        self.counts = {}
+
+    def install(self):
+        # Each testbed gets a new proxy, so this is needed for each.
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self._hook)
+
+    def _hook(self, service, call, request, response):
+        name = '%s.%s' % (service, call)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def take(self):
+        counts = self.counts
+        self.counts = {}
+        return counts
+
+class _FakeRequest(object):
+    def __init__(self, params):
+        self.params = params
+
+    def get(self, param, default=None):
+        return self.params.get(param, default)
+
+class _FakeResponseOut(object):
+    def write(self, out):
+        pass
+
+class _FakeResponse(object):
+    def __init__(self):
+        self.headers = {}
+        self.out = _FakeResponseOut()
+
+def _run_handler(handler_class, params):
+    handler = handler_class()
+    handler.initialize(_FakeRequest(params), _FakeResponse())
+    handler.post()
+
+def _peak_memory_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _report(name, stories, seconds, rpcs):
+    print '%-12s %6d stories %8.2f s %8.1f stories/s  peak %d KB' % (
+        name, stories, seconds, stories / max(seconds, 0.000001),
+        _peak_memory_kb())
+    for call in sorted(rpcs.keys()):
+        print '    %-28s %6d (%.2f/story)' % (call, rpcs[call],
+                                              float(rpcs[call]) / stories)
+
+def bench_ingest(count):
+    import backend
+    import bindex
+    import config
+    import model
+    import story_parser
+
+    counter = _RpcCounter()
+    corpus = _make_corpus(count)
+    api_host = _start_fake_api(corpus)
+    print 'ingest %d synthetic stories' % count
+
+    # story_parser on its own
+    to_parse = [(story, model.FullStory(key_name=id, id=id))
+                for (id, story) in corpus]
+    start = time.time()
+    parsed = story_parser.parse_full_stories(to_parse)
+    _report('parse', count, time.time() - start, {})
+
+    # bindex on its own, a task's worth of stories at a time
+    bed = _new_testbed()
+    counter.install()
+    previews = [preview for (preview, story) in parsed]
+    start = time.time()
+    for i in range(0, len(previews), _PAGE_SIZE):
+        bindex.index(previews[i:i + _PAGE_SIZE], backend._BINDEXED_FIELDS,
+                     order_by='publish_date')
+    _report('bindex', count, time.time() - start, counter.take())
+    bed.deactivate()
+
+    # The whole pipeline, starting from an empty datastore: fetch
+    # every page from the fake API, then parse what got stored.
+    bed = _new_testbed()
+    config.NPR_API_HOSTNAME.set(api_host)
+    counter.install()
+    start = time.time()
+    for offset in range(1, count + 1, _PAGE_SIZE):
+        _run_handler(backend.FetchXml, dict(offset=str(offset),
+                                            count=str(_PAGE_SIZE),
+                                            force='False'))
+    _report('FetchXml', count, time.time() - start, counter.take())
+
+    start = time.time()
+    for i in range(0, count, _PAGE_SIZE):
+        ids = [id for (id, story) in corpus[i:i + _PAGE_SIZE]]
+        _run_handler(backend.ParseXml, dict(ids=','.join(ids)))
+    _report('ParseXml', count, time.time() - start, counter.take())
+    bed.deactivate()
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    _new_testbed()
+
+    bench_split_page()
+    bench_parse_dates()
+    bench_parse_stories()
+    bench_ingest(_CORPUS_SIZE)
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import datetime
 import sys
 import unittest
 
@@ -36,6 +37,9 @@ class TestObject(db.Model):
 
 _PROPERTIES = ['s','i', 'str_list']
 
+class OtherObject(db.Model):
+    s = db.StringProperty()
+
 class TestBindex(unittest.TestCase):
     def setUp(self):
         self.testbed = testbed.Testbed()
@@ -86,14 +90,234 @@ class TestBindex(unittest.TestCase):
         self.assertEquals(2, res.counts()['string'])
         self.assertEquals(1, res.counts()['no'])        
 
+    def testFacets(self):
+        facets = bindex.facets(['s', 'str_list', 'no_field'])
+        self.assertEquals(['no', 'string'], facets['s'].list())
+        self.assertEquals({'bar': 1, 'baz': 2, 'foo': 1, 'quux': 1},
+                          facets['str_list'].counts())
+        self.assertEquals([], facets['no_field'].list())
+
+    def testFacets_updated(self):
+        # Build the summary first, so it has to be kept up to date
+        bindex.facets(['s'])
+        old = TestObject(key_name='key_name3', s='no',
+                         str_list=['foo', 'bar', 'baz'])
+        new = TestObject(key_name='key_name3', s='new',
+                         str_list=['foo', 'bar', 'baz'])
+        bindex.update([(old, new)], _PROPERTIES)
+        bindex.index(TestObject(key_name='key_name4', s='new'), _PROPERTIES)
+
+        self.assertEquals({'new': 2, 'string': 2},
+                          bindex.list_values('s').counts())
+        self.assertEquals(1, bindex._BIndexSummary.all().count())
+
+    def testFacets_staleSummary(self):
+        old = TestObject(key_name='key_name3', s='no')
+        new = TestObject(key_name='key_name3', s='new')
+        bindex.update([(old, new)], _PROPERTIES)
+        # The heads got written but the summary didn't
+        bindex._update_summary({('s', 'new'): 0, ('s', 'no'): 1})
+        bindex.update([(old, new)], _PROPERTIES)
+
+        self.assertEquals({'new': 1, 'string': 2},
+                          bindex.list_values('s').counts())
+
+    def testFacets_retriedUpdate(self):
+        bindex.facets(['s'])
+        old = TestObject(key_name='key_name3', s='no')
+        new = TestObject(key_name='key_name3', s='new')
+        # A task that's retried applies the same changes twice
+        bindex.update([(old, new)], _PROPERTIES)
+        bindex.update([(old, new)], _PROPERTIES)
+
+        self.assertEquals({'new': 1, 'string': 2},
+                          bindex.list_values('s').counts())
+
+    def testQuery_prefix(self):
+        res = bindex.query('str_list ^= ba').run()
+        self.assertEquals(['key_name1', 'key_name3'],
+                          sorted([key.name() for key in res]))
+
+    def testQuery_prefixTooMany(self):
+        old_max = bindex._MAX_PREFIX_VALUES
+        bindex._MAX_PREFIX_VALUES = 1
+        try:
+            self.assertRaises(bindex.QueryError, bindex.query,
+                              'str_list ^= ba')
+        finally:
+            bindex._MAX_PREFIX_VALUES = old_max
+        res = bindex.query('str_list', 'qu', '^=').run()
+        self.assertEquals(['key_name2'], [key.name() for key in res])
+        self.assertEquals(0, bindex.query('s ^= x').count())
+
     def testIndex(self):
         i = bindex._BIndex.all().filter('i =', 7).get()
-        self.assertEquals(1, len(i.refs))
+        self.assertEquals(1, i.count)
+        self.assertEquals(1, len(list(bindex._BIndexQuery([i]).run())))
+
+    def testIndex_shards(self):
+        old_shard_size = bindex._SHARD_SIZE
+        bindex._SHARD_SIZE = 2
+        try:
+            objs = [TestObject(key_name='sharded%d' % n, s='sharded')
+                    for n in range(7)]
+            # Index them out of order, and one at a time, so both the
+            # tail and the middle shards get split.
+            for n in [0, 1, 2, 6, 5, 3, 4]:
+                bindex.index(objs[n], _PROPERTIES)
+            bindex.index(objs, _PROPERTIES)
+        finally:
+            bindex._SHARD_SIZE = old_shard_size
+
+        i = bindex._BIndex.get_by_key_name('s=sharded')
+        self.assertEquals(7, i.count)
+        self.assertTrue(len(i.shard_ids) >= 4)
+
+        names = [r.name() for r in bindex.query('s', 'sharded').run()]
+        self.assertEquals(['sharded%d' % n for n in range(7)], names)
+
+    def testIndex_legacyRefs(self):
+        obj = TestObject(key_name='legacy1', s='legacy')
+        head = bindex._BIndex(key_name='s=legacy', s='legacy', count=1,
+                              refs=[obj.key()])
+        head.put()
+        self.assertEquals(['legacy1'],
+                          [r.name() for r in bindex._BIndexQuery([head]).run()])
+
+        bindex.index(TestObject(key_name='legacy2', s='legacy'), _PROPERTIES)
+        head = bindex._BIndex.get_by_key_name('s=legacy')
+        self.assertEquals(2, head.count)
+        self.assertFalse('refs' in head.dynamic_properties())
+        self.assertEquals(['legacy1', 'legacy2'],
+                          [r.name() for r in bindex._BIndexQuery([head]).run()])
+
+    def testUpdate_reorders(self):
+        # setUp indexed everything unordered; moving over to an order
+        # keeps the postings of the objects that didn't change.
+        old = TestObject.get_by_key_name('key_name2')
+        new = TestObject(key_name='key_name2', s='string', i=3,
+                         str_list=['quux'])
+        new.put()
+        bindex.update([(old, new)], _PROPERTIES, order_by='i')
+
+        self.assertEquals('i', bindex._BIndex.get_by_key_name('s=string').order_by)
+        self.assertEquals(['key_name1', 'key_name2'],
+                          [key.name() for key in bindex.query('s = string').run()])
+
+    def testUpdate_reordersLegacyRefs(self):
+        objs = [TestObject(key_name='legacy1', s='legacy', i=1),
+                TestObject(key_name='legacy2', s='legacy', i=2),
+                OtherObject(key_name='other', s='legacy')]
+        db.put(objs)
+        bindex._BIndex(key_name='s=legacy', s='legacy', count=3,
+                       refs=[obj.key() for obj in objs]).put()
+
+        new = TestObject(key_name='legacy3', s='legacy', i=3)
+        new.put()
+        bindex.update([(None, new)], ['s'], order_by='i')
+
+        # Newest first, without the other kind of object
+        self.assertEquals(['legacy3', 'legacy2', 'legacy1'],
+                          [key.name() for key in bindex.query('s = legacy').run()])
+        self.assertEquals(3, bindex._BIndex.get_by_key_name('s=legacy').count)
+
+    def testReorderHeads(self):
+        # Nothing changes, so only reorder_heads() gets to these
+        obj2 = TestObject.get_by_key_name('key_name2')
+        obj2.i = 3
+        obj2.put()
+        old_batch = bindex._REORDER_BATCH
+        bindex._REORDER_BATCH = 2
+        try:
+            cursor = None
+            total = 0
+            while True:
+                (converted, cursor) = bindex.reorder_heads('i', TestObject,
+                                                           cursor)
+                total += converted
+                if cursor is None:
+                    break
+        finally:
+            bindex._REORDER_BATCH = old_batch
+
+        self.assertTrue(total > 0)
+        for head in bindex._BIndex.all():
+            self.assertEquals('i', head.order_by)
+        self.assertEquals(['key_name1', 'key_name2'],
+                          [key.name() for key in bindex.query('s = string').run()])
+        # key_name3 was never stored, so it's gone from the index
+        self.assertEquals(None, bindex._BIndex.get_by_key_name('s=no'))
+
+    def testUpdate(self):
+        # Cache the results first; the update has to invalidate them
+        self.assertEquals(2, bindex.query('s', 'string').count())
+        self.assertEquals(1, bindex.query('str_list = quux').count())
+
+        old = TestObject(key_name='key_name3', s='no',
+                         str_list=['foo', 'bar', 'baz'])
+        new = TestObject(key_name='key_name3', s='string',
+                         str_list=['bar', 'baz', 'quux'])
+        bindex.update([(old, new)], _PROPERTIES)
+
+        # Nothing has 'no' or 'foo' any more
+        self.assertEquals(None, bindex._BIndex.get_by_key_name('s=no'))
+        self.assertEquals(None,
+                          bindex._BIndex.get_by_key_name('str_list=foo'))
+        self.assertEquals(['string'], bindex.list_values('s').list())
+
+        self.assertEquals(3, bindex.query('s', 'string').count())
+        self.assertEquals(2, bindex.query('str_list', 'quux').count())
+        self.assertEquals(2, bindex.query('str_list = quux').count())
+        # Unchanged values are left alone
+        self.assertEquals(2, bindex.query('str_list', 'baz').count())
+
+    def testUpdate_removed(self):
+        old = TestObject(key_name='key_name2', s='string',
+                         str_list=['quux'])
+        bindex.update([(old, None)], _PROPERTIES)
+        names = [r.name() for r in bindex.query('s', 'string').run()]
+        self.assertEquals(['key_name1'], names)
+        self.assertEquals(None,
+                          bindex._BIndex.get_by_key_name('str_list=quux'))
+
+    def testUpdate_shards(self):
+        old_shard_size = bindex._SHARD_SIZE
+        bindex._SHARD_SIZE = 2
+        try:
+            objs = [TestObject(key_name='sharded%d' % n, s='sharded')
+                    for n in range(7)]
+            bindex.index(objs, _PROPERTIES)
+            shards = len(bindex._BIndex.get_by_key_name('s=sharded').shard_ids)
+            # Empty out a middle shard
+            bindex.update([(objs[2], None), (objs[3], None)], _PROPERTIES)
+        finally:
+            bindex._SHARD_SIZE = old_shard_size
+
+        i = bindex._BIndex.get_by_key_name('s=sharded')
+        self.assertEquals(5, i.count)
+        self.assertEquals(shards - 1, len(i.shard_ids))
+        # The emptied shard is gone from the datastore too
+        stored = bindex._BIndexShard.get_by_key_name(
+            [bindex._shard_key_name('s=sharded', n) for n in range(20)])
+        self.assertEquals(len(i.shard_ids),
+                          len([s for s in stored if s is not None]))
+
+        names = [r.name() for r in bindex.query('s', 'sharded').run()]
+        self.assertEquals(['sharded%d' % n for n in [0, 1, 4, 5, 6]], names)
 
     def testStringListIndex(self):
         res = list(bindex._BIndex.all().filter('str_list !=', 'NULL').run())
         self.assertEquals(4, len(res))
         
+    def testIndex_sharedEntry(self):
+        # Both properties map to the same entry, which should only
+        # link the object once.
+        obj = TestObject(key_name='key_name6', s='shared',
+                         str_list=['shared'])
+        bindex.index(obj, ['s', 's'])
+        i = bindex._BIndex.get_by_key_name('s=shared')
+        self.assertEquals(1, i.count)
+
     def testQuery(self):
         res = bindex.query('s', 'string').run()
         for r in res:
@@ -120,6 +344,21 @@ class TestBindex(unittest.TestCase):
         for r in res:
             self.fail('should be empty')
 
+    def testIndex_list(self):
+        obj4 = TestObject(key_name='key_name4', s='batch',
+                          str_list=['batch_value'])
+        obj5 = TestObject(key_name='key_name5', s='batch',
+                          str_list=['batch_value', 'baz'])
+        db.put([obj4, obj5])
+        bindex.index([obj4, obj5, obj4], _PROPERTIES)
+
+        q = bindex.query('s', 'batch')
+        self.assertEquals(2, q.count())
+        q = bindex.query('str_list', 'batch_value')
+        self.assertEquals(2, q.count())
+        q = bindex.query('str_list', 'baz')
+        self.assertEquals(3, q.count())
+
     def testQuery_comparison(self):
         q = bindex.query('i', 1, operator='>')
         self.assertEquals(1, q.count()) 
@@ -133,5 +372,96 @@ class TestBindex(unittest.TestCase):
             self.fail('should be empty')
                         
 
+class TestDatedObject(db.Model):
+    s = db.StringProperty()
+    i = db.IntegerProperty()
+    str_list = db.StringListProperty()
+    d = db.DateTimeProperty()
+
+class TestBindexExpression(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+        objs = [
+            TestDatedObject(key_name='a', s='x', i=1, str_list=['red'],
+                            d=datetime.datetime(2011, 1, 1)),
+            TestDatedObject(key_name='b', s='x', i=2,
+                            str_list=['red', 'blue green'],
+                            d=datetime.datetime(2011, 3, 1)),
+            TestDatedObject(key_name='c', s='y', i=2, str_list=['blue green'],
+                            d=datetime.datetime(2011, 2, 1)),
+            TestDatedObject(key_name='d', s='y', i=3, str_list=[],
+                            d=datetime.datetime(2010, 6, 1)),
+            ]
+        bindex.index(objs, _PROPERTIES, order_by='d')
+
+    def _names(self, expression):
+        return [k.name() for k in bindex.query(expression).run()]
+
+    def testSingleTerm(self):
+        # Newest first
+        self.assertEquals(['b', 'a'], self._names('s = x'))
+        self.assertEquals(['b', 'c'], self._names('i = 2'))
+
+    def testAnd(self):
+        self.assertEquals(['b'], self._names('s = x AND i = 2'))
+        self.assertEquals([], self._names('s = x AND i = 3'))
+
+    def testOr(self):
+        self.assertEquals(['b', 'c', 'a'],
+                          self._names("str_list = 'blue green' OR i = 1"))
+
+    def testNot(self):
+        self.assertEquals(['a'], self._names('s = x AND NOT i = 2'))
+        self.assertEquals(['c', 'd'],
+                          self._names('NOT str_list = red AND i > 1'))
+
+    def testParens(self):
+        self.assertEquals(['c', 'a'],
+                          self._names('(s = x OR s = y) AND '
+                                      'NOT (i = 3 OR d = "nope") AND '
+                                      'NOT (s = x AND i = 2)'))
+
+    def testComparison(self):
+        self.assertEquals(['b', 'c', 'd'], self._names('i >= 2'))
+
+    def testFetch(self):
+        q = bindex.query('i > 0')
+        self.assertEquals(4, q.count())
+        self.assertEquals(['b', 'c'], [k.name() for k in q.fetch(2)])
+        self.assertEquals(['a', 'd'], [k.name() for k in q.fetch(5, offset=2)])
+
+    def testFetchPage(self):
+        q = bindex.query('i > 0')
+        (keys, next_cursor, prev_cursor) = q.fetch_page(3)
+        self.assertEquals(['b', 'c', 'a'], [k.name() for k in keys])
+        self.assertEquals(None, prev_cursor)
+
+        (keys, last_cursor, prev_cursor) = q.fetch_page(3, next_cursor)
+        self.assertEquals(['d'], [k.name() for k in keys])
+        self.assertEquals(None, last_cursor)
+        self.assertEquals('', prev_cursor)
+
+        (keys, next_cursor, prev_cursor) = q.fetch_page(1, next_cursor)
+        (keys, next_cursor, prev_cursor) = q.fetch_page(1, prev_cursor)
+        self.assertEquals(['a'], [k.name() for k in keys])
+
+        self.assertRaises(bindex.QueryError, q.fetch_page, 1, u'\u00e9')
+
+    def testQuote(self):
+        expression = ' AND '.join([bindex.quote('str_list', 'blue green'),
+                                   bindex.quote('i', 2)])
+        self.assertEquals('str_list = "blue green" AND i = 2', expression)
+        self.assertEquals(['b', 'c'], self._names(expression))
+
+    def testErrors(self):
+        for expression in ['NOT s = x', 's = x OR NOT i = 2', 's =',
+                           '(s = x', 's = x AND', 's x']:
+            self.assertRaises(bindex.QueryError, bindex.query, expression)
+
 if __name__ == '__main__':
     test_setup.main('bindex')
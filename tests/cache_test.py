@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+
+import test_setup
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import cache
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+        self.old_chunk_size = cache._CHUNK_SIZE
+        cache._CHUNK_SIZE = 100
+
+    def tearDown(self):
+        cache._CHUNK_SIZE = self.old_chunk_size
+
+    def testSmall(self):
+        self.assertTrue(cache.set('small', [1, 2]))
+        self.assertEquals([1, 2], cache.get('small'))
+
+    def testMissing(self):
+        self.assertEquals(None, cache.get('missing'))
+
+    def testOldEntries(self):
+        # Written straight to memcache before there was a cache module
+        memcache.set('old_list', ['a', 'b'])
+        memcache.set('old_str', 'some text')
+        memcache.set('old_looks_chunked', 'c:not a header')
+        for key in ['old_list', 'old_str', 'old_looks_chunked']:
+            self.assertEquals(None, cache.get(key))
+
+    def testChunked(self):
+        value = ['%050d' % i for i in range(20)]
+        self.assertTrue(cache.set('big', value))
+        self.assertEquals(value, cache.get('big'))
+
+        # Overwriting with a small value works too
+        cache.set('big', 'small now')
+        self.assertEquals('small now', cache.get('big'))
+
+    def testChunked_evicted(self):
+        cache.set('big', ['%050d' % i for i in range(20)])
+        (nonce, count, digest) = memcache.get('big')[1:].split(':')
+        memcache.delete('big:%s:1' % nonce)
+        self.assertEquals(None, cache.get('big'))
+
+    def testChunked_corrupt(self):
+        cache.set('big', ['%050d' % i for i in range(20)])
+        (nonce, count, digest) = memcache.get('big')[1:].split(':')
+        memcache.set('big:%s:0' % nonce, 'y' * 100)
+        self.assertEquals(None, cache.get('big'))
+
+    def testLongKey(self):
+        key = 'k' * 1000
+        cache.set(key, 'value')
+        self.assertEquals('value', cache.get(key))
+        cache.delete(key)
+        self.assertEquals(None, cache.get(key))
+
+    def testGenerations(self):
+        key = cache.generation_key('gen', ['a', 'b'])
+        cache.set(key, 'value')
+        self.assertEquals(key, cache.generation_key('gen', ['a', 'b']))
+
+        cache.bump_generations(['b'])
+        new_key = cache.generation_key('gen', ['a', 'b'])
+        self.assertNotEquals(key, new_key)
+        self.assertEquals(None, cache.get(new_key))
+        # Only b moved on
+        self.assertEquals(cache.generation_key('gen', ['a']).split('@')[1],
+                          key.split('@')[1].split('.')[0])
+
+if __name__ == '__main__':
+    test_setup.main('cache')
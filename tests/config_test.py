@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+
+import test_setup
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import config
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        config.invalidate()
+
+    def testDefaults(self):
+        self.assertEquals('api.npr.org', config.NPR_API_HOSTNAME.get())
+        self.assertEquals(20, config.NUM_STORIES_TO_FETCH.get())
+        self.assertEquals(True, config.AUTO_PARSE_XML.get())
+
+        # Every default got stored in one go
+        self.assertEquals(len(config._configs),
+                          config._TextConfig.all().count())
+
+    def testNewConfig(self):
+        # Cached by an older version that didn't have every config
+        memcache.set(config._MEMCACHE_KEY, {'npr_api_key': 'key'})
+        self.assertEquals('key', config.NPR_API_KEY.get())
+        self.assertEquals(10, config.RECENT_STORIES_COUNT.get())
+        self.assertEquals(
+            '10', config._TextConfig.get_by_key_name('recent_stories_count').value)
+
+    def testSet(self):
+        self.assertEquals(False, config.JS_COMPILED.get())
+        config.JS_COMPILED.set(True)
+        self.assertEquals(True, config.JS_COMPILED.get())
+
+        # Other instances see it once their copy expires
+        config._values = None
+        self.assertEquals(True, config.JS_COMPILED.get())
+
+    def testExpiry(self):
+        config.RECENT_STORIES_COUNT.get()
+        # Edited behind our back, e.g. in the datastore viewer
+        config._TextConfig(key_name='recent_stories_count', value='5').put()
+        memcache.delete(config._MEMCACHE_KEY)
+        self.assertEquals(10, config.RECENT_STORIES_COUNT.get())
+
+        config._loaded_at -= config._TTL_SEC + 1
+        self.assertEquals(5, config.RECENT_STORIES_COUNT.get())
+
+if __name__ == '__main__':
+    test_setup.main('config')
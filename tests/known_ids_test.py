@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+
+import test_setup
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import known_ids
+
+class TestKnownIds(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+        known_ids.add(['137378586', '137378590', '137400001'])
+
+    def testFindKnown(self):
+        known = known_ids.find_known(['137378586', '137378587',
+                                      '137400001', '1'])
+        self.assertEquals(set(['137378586', '137400001']), known)
+
+    def testFindKnown_coldCache(self):
+        memcache.flush_all()
+        known = known_ids.find_known(['137378590', '137378591'])
+        self.assertEquals(set(['137378590']), known)
+
+    def testAdd_existingBucket(self):
+        known_ids.add(['137378591'])
+        known = known_ids.find_known(['137378586', '137378591'])
+        self.assertEquals(set(['137378586', '137378591']), known)
+
+    def testDigests(self):
+        known_ids.add({'137378586': 'abc', '137378587': 'def'})
+        digests = known_ids.get_digests(['137378586', '137378587',
+                                         '137378590', '137378591'])
+        self.assertEquals({'137378586': 'abc',
+                           '137378587': 'def',
+                           '137378590': None}, digests)
+
+    def testDigests_notOverwrittenByUnknown(self):
+        known_ids.add({'137378586': 'abc'})
+        known_ids.add(['137378586'])
+        memcache.flush_all()
+        self.assertEquals({'137378586': 'abc'},
+                          known_ids.get_digests(['137378586']))
+
+    def testBuckets(self):
+        self.assertEquals(2, known_ids._KnownIdBucket.all().count())
+
+if __name__ == '__main__':
+    test_setup.main('known_ids')
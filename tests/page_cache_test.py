@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import StringIO
+import unittest
+
+import test_setup
+
+from google.appengine.ext import testbed
+
+import page_cache
+
+class FakeRequest(object):
+    def __init__(self, params={}, headers={}):
+        self.host = 'localhost'
+        self.path = '/'
+        self.params = params
+        self.headers = headers
+
+    def get(self, param, default=None):
+        return self.params.get(param, default)
+
+    def arguments(self):
+        return self.params.keys()
+
+class FakeResponse(object):
+    def __init__(self):
+        self.headers = {'Content-Type': 'text/html; charset=utf-8'}
+        self.out = StringIO.StringIO()
+        self.status = 200
+
+    def set_status(self, status):
+        self.status = status
+
+    def clear(self):
+        self.out = StringIO.StringIO()
+
+class FakePage(object):
+    renders = 0
+
+    def __init__(self, request):
+        self.request = request
+        self.response = FakeResponse()
+
+    @page_cache.cached(['topic', 'year', 'missing'])
+    def get(self):
+        FakePage.renders += 1
+        if self.request.get('missing'):
+            self.response.set_status(404)
+            return
+        self.response.out.write(u'topic is %s' % self.request.get('topic'))
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        FakePage.renders = 0
+
+    def _get(self, params={}, headers={}):
+        page = FakePage(FakeRequest(params, headers))
+        page.get()
+        return page.response
+
+    def testCached(self):
+        first = self._get({'topic': u'Movies', 'year': u'2011'})
+        self.assertEquals('topic is Movies', first.out.getvalue())
+        second = self._get({'year': u'2011', 'topic': u'Movies'})
+        self.assertEquals('topic is Movies', second.out.getvalue())
+        self.assertEquals(1, FakePage.renders)
+        self.assertEquals(first.headers['ETag'], second.headers['ETag'])
+
+        self._get({'topic': u'Books'})
+        self.assertEquals(2, FakePage.renders)
+
+    def testOtherParamsIgnored(self):
+        self._get({'topic': u'Movies'})
+        self._get({'topic': u'Movies', 'utm_source': u'feed', 'year': u''})
+        self.assertEquals(1, FakePage.renders)
+
+    def testNotModified(self):
+        etag = self._get().headers['ETag']
+        response = self._get(headers={'If-None-Match': etag})
+        self.assertEquals(304, response.status)
+        self.assertEquals('', response.out.getvalue())
+
+        response = self._get(headers={'If-None-Match': '"other"'})
+        self.assertEquals(200, response.status)
+
+    def testNotModifiedSince(self):
+        last_modified = self._get().headers['Last-Modified']
+        response = self._get(headers={'If-Modified-Since': last_modified})
+        self.assertEquals(304, response.status)
+
+    def testNewGeneration(self):
+        self._get()
+        page_cache.content_changed()
+        self._get()
+        self.assertEquals(2, FakePage.renders)
+
+    def testErrorsNotCached(self):
+        self.assertEquals(404, self._get({'missing': u'1'}).status)
+        self.assertEquals(404, self._get({'missing': u'1'}).status)
+        self.assertEquals(2, FakePage.renders)
+
+if __name__ == '__main__':
+    test_setup.main('page_cache')
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+
+import test_setup
+
+from google.appengine.ext import testbed
+from google.appengine.ext import webapp
+
+import model
+import rest
+import story_parser
+
+class TestRest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+        fp = open('tests/story.xml')
+        xml = fp.read()
+        fp.close()
+        full_story = model.FullStory(key_name='137378586', id='137378586')
+        full_story.put()
+        (preview, story) = story_parser.parse_full_story(xml, full_story)
+        preview.put()
+        story.put()
+
+    def _get(self, handler_class, url, headers={}):
+        request = webapp.Request.blank(url)
+        for (name, value) in headers.items():
+            request.headers[name] = value
+        response = webapp.Response()
+        handler = handler_class()
+        handler.initialize(request, response)
+        handler.get()
+        return response
+
+    def _get_json(self, handler_class, url):
+        response = self._get(handler_class, url)
+        return (response.status, rest.json.loads(response.out.getvalue()))
+
+    def testStories(self):
+        (status, res) = self._get_json(rest.StoriesHandler,
+                                       '/rest/stories?ids=137378586,1')
+        self.assertEquals(200, status)
+        self.assertEquals(2, len(res['stories']))
+        self.assertEquals('137378586', res['stories'][0]['id'])
+        self.assertEquals(sorted([name for (name, attr)
+                                  in rest._PREVIEW_FIELDS]),
+                          sorted(res['stories'][0].keys()))
+        self.assertEquals(None, res['stories'][1])
+
+    def testStories_fields(self):
+        (status, res) = self._get_json(
+            rest.StoriesHandler,
+            '/rest/stories?ids=137378586&fields=id,title')
+        self.assertEquals(200, status)
+        self.assertEquals(['id', 'title'], sorted(res['stories'][0].keys()))
+
+    def testStories_fullView(self):
+        (status, res) = self._get_json(
+            rest.StoriesHandler,
+            '/rest/stories?ids=137378586&view=full&fields=id,text')
+        self.assertEquals(200, status)
+        self.assertTrue('Meatballs' in res['stories'][0]['text'])
+
+    def testBadRequests(self):
+        for (handler_class, url) in [
+            (rest.StoriesHandler, '/rest/stories'),
+            (rest.StoriesHandler, '/rest/stories?ids=1&fields=id,nope'),
+            (rest.StoriesHandler, '/rest/stories?ids=1&view=huge'),
+            (rest.StoriesHandler, '/rest/stories?ids=%D9%A1'),
+            (rest.ListingHandler, '/rest/listing?view=full'),
+            (rest.ListingHandler, '/rest/listing?count=1000'),
+            (rest.ListingHandler, '/rest/listing?cursor=garbage'),
+            (rest.SearchHandler, '/rest/search?q=teacher&count=x')]:
+            (status, res) = self._get_json(handler_class, url)
+            self.assertEquals(400, status, url)
+            self.assertTrue('error' in res, url)
+
+    def testNotModified(self):
+        url = '/rest/stories?ids=137378586'
+        etag = self._get(rest.StoriesHandler, url).headers['ETag']
+        response = self._get(rest.StoriesHandler, url,
+                             {'If-None-Match': etag})
+        self.assertEquals(304, response.status)
+        self.assertEquals('', response.out.getvalue())
+
+if __name__ == '__main__':
+    test_setup.main('rest')
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2011 by Bill Napier (napier@pobox.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at:
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+
+import test_setup
+
+from google.appengine.ext import testbed
+
+import model
+import queries
+import search
+import story_parser
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.setup_env(app_id='npr-fresh-air')
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+        fp = open('tests/story.xml')
+        self.story_xml = fp.read()
+        fp.close()
+
+    def _parse(self, id, xml):
+        full_story = model.FullStory(key_name=id, id=id)
+        full_story.put()
+        (preview, story) = story_parser.parse_full_story(xml, full_story)
+        preview.put()
+        story.put()
+        return story
+
+    def _search(self, text):
+        return [story.id for story in queries.search_stories(text).stories]
+
+    def testGetWords(self):
+        self.assertEquals(set(['bad', 'teacher', 'don', '2011']),
+                          search.get_words(u"The Bad teacher, don't... 2011"))
+        self.assertEquals(set(), search.get_words(None))
+
+    def testGetTerms(self):
+        self.assertEquals(['bad', 'teach*'], search.get_terms('the Bad teach*'))
+        # Only the start of a long prefix is compared
+        self.assertEquals(['teach*'], search.get_terms('teacher*'))
+        self.assertEquals(['x'], search.get_terms('x*'))
+        self.assertEquals([], search.get_terms('the  '))
+
+    def testSearch(self):
+        story = self._parse('137378586', self.story_xml)
+        search.update([(None, story)])
+
+        self.assertEquals(['137378586'], self._search('cameron diaz'))
+        # Only in the body text
+        self.assertEquals(['137378586'], self._search('Meatballs'))
+        self.assertEquals(['137378586'], self._search('meatb*'))
+        self.assertEquals([], self._search('diaz ghostbusters'))
+        self.assertEquals([], self._search('the'))
+
+        # One entity per story
+        self.assertEquals(1, search._StoryWords.all().count())
+
+    def testSearch_newestFirst(self):
+        old = self._parse('1', self.story_xml.replace(
+            '2011', '2010').replace('137378586', '1'))
+        new = self._parse('137378586', self.story_xml)
+        search.update([(None, old), (None, new)])
+        self.assertEquals(['137378586', '1'], self._search('teacher'))
+
+    def testUpdate_reparse(self):
+        old = self._parse('137378586', self.story_xml)
+        search.update([(None, old)])
+        self.assertEquals(['137378586'], self._search('meatballs'))
+
+        new = self._parse('137378586',
+                          self.story_xml.replace('Meatballs', 'Caddyshack'))
+        search.update([(old, new)])
+        self.assertEquals([], self._search('meatballs'))
+        self.assertEquals(['137378586'], self._search('caddyshack'))
+        self.assertEquals(['137378586'], self._search('cameron diaz'))
+
+    def testUpdate_capped(self):
+        old_max = search._MAX_VALUES
+        search._MAX_VALUES = 50
+        try:
+            story = self._parse('137378586', self.story_xml)
+            search.update([(None, story)])
+        finally:
+            search._MAX_VALUES = old_max
+        self.assertEquals(50, len(search._StoryWords.all().get().words))
+        # Title words come first
+        self.assertEquals(['137378586'], self._search('bad teacher'))
+
+    def testUpdate_unchanged(self):
+        old = self._parse('137378586', self.story_xml)
+        search.update([(None, old)])
+        # Marked so a write would show
+        words = search._StoryWords.all().get()
+        words.words = ['marked']
+        words.put()
+        new = self._parse('137378586', self.story_xml)
+        search.update([(old, new)])
+        self.assertEquals(['marked'], search._StoryWords.all().get().words)
+
+    def testUpdate_newPublishDate(self):
+        old = self._parse('137378586', self.story_xml)
+        search.update([(None, old)])
+        new = self._parse('137378586', self.story_xml.replace('2011', '2010'))
+        search.update([(old, new)])
+        self.assertEquals(1, search._StoryWords.all().count())
+        self.assertEquals(['137378586'], self._search('teacher'))
+
+    def testUpdate_olderParser(self):
+        # Parsed before stories were searchable, so never indexed
+        old = self._parse('137378586', self.story_xml)
+        old.xml_parser_version = 2
+        new = self._parse('137378586', self.story_xml)
+        search.update([(old, new)])
+        self.assertEquals(['137378586'], self._search('diaz'))
+
+    def testSearch_pages(self):
+        for id in ['1', '2', '3']:
+            story = self._parse(id, self.story_xml.replace('137378586', id))
+            search.update([(None, story)])
+        first = queries.search_stories('teacher', count=2)
+        self.assertEquals(2, len(first.stories))
+        self.assertEquals(None, first.prev_cursor)
+        second = queries.search_stories('teacher', count=2,
+                                        cursor=first.next_cursor)
+        self.assertEquals(1, len(second.stories))
+        self.assertEquals(None, second.next_cursor)
+        self.assertEquals('', second.prev_cursor)
+
+if __name__ == '__main__':
+    test_setup.main('search')
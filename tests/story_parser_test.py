@@ -47,6 +47,20 @@ class TestSequenceFunctions(unittest.TestCase):
         utc = dt.utctimetuple()
         self.assertEquals(15, utc.tm_hour)
 
+    def test_parse_datetime_slow(self):
+        for when in ['Thu, 23 Jun 2011 11:02:04 -0400',
+                     'Sat, 01 Jan 2011 00:00:00 +0530',
+                     ' Fri, 24 Jun 2011 11:00:00  -0400 ']:
+            fast = story_parser._parse_into_datetime(when)
+            slow = story_parser._parse_into_datetime_slow(when)
+            self.assertEquals(slow, fast)
+            self.assertEquals(slow.utcoffset(), fast.utcoffset())
+
+    def test_parse_datetime_sharedTimezone(self):
+        a = story_parser._parse_into_datetime('Thu, 23 Jun 2011 11:02:04 -0400')
+        b = story_parser._parse_into_datetime('Fri, 24 Jun 2011 11:00:00 -0400')
+        self.assertTrue(a.tzinfo is b.tzinfo)
+
     def test_datetime_into_year(self):
         when = datetime.datetime(2011, 4, 4, 13, 27, 30)
         self.assertEqual(2011,
@@ -114,8 +128,49 @@ class TestSequenceFunctions(unittest.TestCase):
                           preview.story_url)
         self.assertEquals('http://www.npr.org/2011/06/24/137378586/class-is-dismissed-bad-teacher-is-crude-but-fun?ft=3&f=13',
                           parsed_story.story_url)
-        
-                        
+
+    def test_parse_story_text(self):
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        parent = model.FullStory(key_name='0', id='0', xml='')
+        (preview, parsed_story) = story_parser.parse_full_story(story_xml, parent)
+
+        paragraphs = parsed_story.text.split('\n')
+        self.assertEquals(9, len(paragraphs))
+        self.assertTrue(paragraphs[0].startswith('Bad Teacher is a raunchy comedy'))
+        self.assertTrue(paragraphs[-1].endswith('[Copyright 2011 National Public Radio]'))
+        self.assertTrue(parsed_story.text_with_html.startswith(
+            '<em>Bad Teacher</em> is a raunchy comedy'))
+
+    def test_parse_compressed_story(self):
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        parent = model.FullStory(key_name='0', id='0')
+        parent.set_xml(story_xml)
+        self.assertEquals(model.XML_FORMAT_ZLIB, parent.xml_format)
+        self.assertTrue(len(parent.compressed_xml) < len(story_xml))
+
+        (preview, parsed_story) = story_parser.parse_full_story(parent.get_xml(), parent)
+        self.assertEquals('137378586', preview.id)
+        self.assertEquals('Movie Reviews', parsed_story.column)
+
+    def test_parse_stories(self):
+        fp = open('tests/story.xml')
+        story_xml = fp.read()
+        fp.close()
+        parents = [model.FullStory(key_name=id, id=id) for id in ['0', '1']]
+        parsed = story_parser.parse_full_stories([(story_xml, parent)
+                                                  for parent in parents])
+        self.assertEquals(2, len(parsed))
+        for ((preview, parsed_story), parent) in zip(parsed, parents):
+            self.assertEquals(parent.key(), preview.parent_key())
+            self.assertEquals(preview.key(), parsed_story.parent_key())
+            self.assertEquals('137378586', parsed_story.id)
+            self.assertEquals(201106, parsed_story.publish_yearmonth)
+            self.assertEquals(story_parser._XML_PARSER_VERSION,
+                              parsed_story.xml_parser_version)
 
 if __name__ == '__main__':
     test_setup.main('story_parser')